@@ -1,13 +1,49 @@
-import altair as alt
+import time
+start_time = time.perf_counter()
+
+# Altair is imported by make_plot, on the first chart render, so that it is
+# not part of the start up time
 import pandas as pd
+import numpy as np
 import json
+import math
+import collections
+import gzip
+import functools
+import hashlib
+import ipaddress
+import os
+import threading
+import bisect
+import cProfile
+import io
+import pstats
+import flask
+try:
+    import brotli
+except ImportError:
+    brotli = None
 import dash
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, ClientsideFunction
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
+# Seconds spent in each start up phase, in order
+startup_times = collections.OrderedDict()
+
+def record_phase(phase, since):
+    """
+    Records the time since "since" as the duration of start up "phase" (only
+    the first time the phase is recorded) and returns the current time
+    """
+    now = time.perf_counter()
+    startup_times.setdefault(phase, now - since)
+    return now
+
+phase_start = record_phase('imports', start_time)
+
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], assets_folder = "assets")
 app.config['suppress_callback_exceptions'] = True
@@ -16,12 +52,127 @@ server = app.server
 
 app.title = 'Squirrel App CG Version'
 
+count_path = 'data/squirrel_count.csv'
+plots_path = 'data/squirrel_plots.json'
+# Simplified TopoJSON version of plots_path, written by scripts/wrangle_full.py
+topo_path = 'data/squirrel_plots.topo.json'
+topo_object = 'zones'
+# Aggregate cube of counts by zone, shift, date, age and fur color, written
+# by scripts/wrangle_full.py. The filters are disabled without it.
+cube_path = 'data/squirrel_cube.npz'
+# Sightings binned at several levels for the point density layer, written by
+# scripts/wrangle_full.py. The layer is disabled without it.
+density_path = 'data/squirrel_density.json'
+# Written by scripts/ingest.py before and after it updates the data files
+version_path = 'data/squirrel_version.json'
+# Longest time in seconds to wait for an update of the data files to finish
+# before loading them anyway
+update_wait = 10.0
+
+def data_version():
+    """
+    Returns the data version written by scripts/ingest.py ({} for data
+    files written by scripts/wrangle_full.py alone)
+    """
+    if not os.path.exists(version_path):
+        return {}
+    with open(version_path) as version_file:
+        return json.load(version_file)
+
+def load_data():
+    """
+    Loads the data files as one consistent set and returns it (see
+    load_files).
+
+    scripts/ingest.py replaces the data files one by one while the app
+    runs, marking the data version as "writing" until it is done. The files
+    are loaded once no update is in progress, and loaded again if the data
+    version changed while they were being read.
+    """
+    deadline = time.monotonic() + update_wait
+    while True:
+        version = data_version()
+        if not version.get('writing'):
+            data = load_files()
+            if data_version() == version:
+                return data
+        if time.monotonic() > deadline:
+            return load_files()
+        time.sleep(0.05)
+
+def reload_data():
+    """
+    Loads the data files again and replaces app_data with them. The new
+    data is swapped in as one reference, so a render that took app_data
+    before the swap keeps using the old data throughout.
+    """
+    global app_data
+    app_data = load_data()
+
+def load_files():
+    """
+    Loads the squirrel count table and the choropleth features used by
+    make_plot, and returns them in a dict with the keys 'csv',
+    'sort_order', 'plots_url', 'plots_format', 'plots_asset', 'cube' and
+    'density'.
+
+    The choropleth features are not inlined into the charts: they are served
+    at a URL named by a hash of their content (see serve_plots_data), so
+    browsers download them once and cache them across renders and page loads.
+    The simplified TopoJSON version is served when it exists, and the full
+    GeoJSON otherwise.
+
+    The aggregate cube is loaded as arrays and the binned sightings as
+    JSON (each is None when its file is missing).
+    """
+    csv = pd.read_csv(count_path)
+    # Zones without a shortened sitename are labelled with their sitename
+    csv['sitename_short'] = csv['sitename_short'].fillna(csv['sitename'])
+    sort_order = list(csv.sort_values(by = ['Unique_Squirrel_ID'])['sitename_short'])
+    if os.path.exists(topo_path):
+        with open(topo_path, 'rb') as data_file:
+            plots_asset = static_asset(data_file.read())
+        plots_format = {'type': 'topojson', 'feature': topo_object}
+    else:
+        with open(plots_path, 'rb') as data_file:
+            plots_asset = static_asset(data_file.read())
+        plots_format = {'type': 'json', 'property': 'features'}
+    plots_url = '/data/squirrel_plots.{}.json'.format(plots_asset['digest'])
+    cube = None
+    if os.path.exists(cube_path):
+        with np.load(cube_path) as stored:
+            cube = {'counts': stored['counts'].astype(np.int64),
+                    'sitename': list(stored['sitename']),
+                    'measures': list(stored['measures']),
+                    'levels': {str(dimension): [str(level) for level in stored['levels_{}'.format(i)]]
+                               for i, dimension in enumerate(stored['dimensions'])}}
+    density = None
+    if os.path.exists(density_path):
+        with open(density_path) as density_file:
+            density = json.load(density_file)
+    return {'csv': csv,
+            'sort_order': sort_order,
+            'plots_url': plots_url,
+            'plots_format': plots_format,
+            'plots_asset': plots_asset,
+            'cube': cube,
+            'density': density}
+
+def static_asset(content):
+    """
+    Returns the content hash of "content" and its identity, gzip and brotli
+    encodings (brotli only if the brotli package is installed)
+    """
+    asset = {'digest': hashlib.sha256(content).hexdigest()[:16],
+             'identity': content,
+             'gzip': gzip.compress(content, compresslevel = 9, mtime = 0)}
+    if brotli is not None:
+        asset['br'] = brotli.compress(content)
+    return asset
+
  # load the data
-csv = pd.read_csv('data/squirrel_count.csv')
-sort_order = list(csv.sort_values(by = ['Unique_Squirrel_ID'])['sitename_short'])
-with open('data/squirrel_plots.json') as data_file:
-    b_json_count = json.load(data_file)
-squirrel_json = alt.Data(values = b_json_count['features'])
+app_data = load_data()
+phase_start = record_phase('data load', phase_start)
 
 # Plot width and height, title font size, axislabel font size
 w = 600
@@ -30,8 +181,112 @@ tfs = 20
 atfs = 18
 lfs = 16
 
+# Behaviors that can be shown in the behavior plot
+behavior_options = [{'label': 'Running or Chasing', 'value': 'Running_or_chasing'},
+                    {'label': 'Climbing', 'value': 'Climbing'},
+                    {'label': 'Eating or Foraging', 'value': 'Eating_or_foraging'},
+                    {'label': 'Vocalizing', 'value': 'Vocalizations'},
+                    {'label': 'Approaches Humans', 'value': 'Approaches'}]
+default_behavior = 'Running_or_chasing'
+
+# "client": the chart carries every behavior and the dropdown switches it in
+# the browser. "server": each dropdown change renders a new chart on the server.
+plot_mode = os.environ.get('SQUIRREL_PLOT_MODE', 'client')
+
+# Filters of the observations shown: cube dimension, dropdown id and the
+# dropdown's placeholder, shown when nothing is picked (all observations)
+filter_controls = [('Shift', 'filter-shift', 'Any time of day'),
+                   ('Date', 'filter-date', 'Any date'),
+                   ('Age', 'filter-age', 'Any age'),
+                   ('Primary Fur Color', 'filter-fur', 'Any fur color')]
+
+def filter_label(dimension, level):
+    """
+    Returns the dropdown label of "level" of cube dimension "dimension"
+    """
+    if dimension == 'Date' and level != 'Unknown':
+        return pd.to_datetime(level, format = '%m%d%Y').strftime('%a %b %d')
+    if dimension == 'Age' and level == '?':
+        return 'Not sure'
+    return level
+
+def view_filters(*selections):
+    """
+    Returns the filters picked in the filter dropdowns (one list of levels,
+    or None, per filter control) as a hashable tuple of (dimension, levels)
+    pairs. Filters that keep every observation are left out, so the tuple is
+    empty when nothing is filtered.
+    """
+    cube = app_data['cube']
+    filters = []
+    for (dimension, _, _), selected in zip(filter_controls, selections):
+        if cube is None or not selected or set(selected) >= set(cube['levels'][dimension]):
+            continue
+        filters.append((dimension, tuple(sorted(selected))))
+    return tuple(filters)
+
+def slice_counts(filters, data = None):
+    """
+    Returns the squirrel count table (as in squirrel_count.csv) of the
+    observations kept by "filters", by slicing and summing the aggregate
+    cube of "data" (app_data if not given). The cost does not depend on the
+    size of the census.
+
+    The AM - PM difference is taken over both shifts even when the shift is
+    filtered, so the difference plot keeps showing the other filters.
+    """
+    data = app_data if data is None else data
+    cube = data['cube']
+    counts = cube['counts']
+    picked = dict(filters)
+    dimensions = list(cube['levels'])
+    for axis, dimension in enumerate(dimensions, start = 1):
+        if dimension in picked and dimension != 'Shift':
+            counts = counts.compress(np.isin(cube['levels'][dimension], picked[dimension]), axis = axis)
+    # Counts by zone, shift and measure
+    by_shift = counts.sum(axis = tuple(range(2, 1 + len(dimensions))))
+    shifts = cube['levels']['Shift']
+    kept = np.isin(shifts, picked['Shift']) if 'Shift' in picked else np.ones(len(shifts), dtype = bool)
+    totals = dict(zip(cube['measures'], by_shift[:, kept].sum(axis = 1).T))
+    am = by_shift[:, shifts.index('AM'), 0] if 'AM' in shifts else np.zeros(len(by_shift))
+    pm = by_shift[:, shifts.index('PM'), 0] if 'PM' in shifts else np.zeros(len(by_shift))
+
+    sliced = pd.DataFrame({'sitename': cube['sitename'],
+                           'Unique_Squirrel_ID': totals['Unique_Squirrel_ID'],
+                           'Climbing': totals['Climbing'],
+                           'Approaches': totals['Approaches'],
+                           'Vocalizations': totals['Kuks'] + totals['Quaas'] + totals['Moans'],
+                           'Running_or_chasing': totals['Running'] + totals['Chasing'],
+                           'Eating_or_foraging': totals['Eating'] + totals['Foraging'],
+                           'Count_diff (AM - PM)': np.where((am > 0) & (pm > 0), am - pm, np.nan)})
+    # Keep the zones of the squirrel count table, which are the zones on the map
+    return data['csv'][['sitename', 'sitename_short']].merge(sliced, on = 'sitename', how = 'left')
+
+# Most marks the point density layer draws, and the smallest bin it shows,
+# in pixels across on the map
+max_density_marks = 600
+min_bin_pixels = 8
+
+def density_level(density):
+    """
+    Returns the binning level of the binned sightings "density" shown on
+    the map: the finest
+    level whose bins are at least min_bin_pixels across on the map and that
+    has at most max_density_marks bins, or the coarsest level if none does
+    """
+    minx, miny, maxx, maxy = density['bounds']
+    # Size of the park in metres, and the map's scale in pixels per metre
+    width = (maxx - minx) * 111320 * math.cos(math.radians((miny + maxy) / 2))
+    height = (maxy - miny) * 111320
+    pixels_per_metre = min(w / width, h / height)
+    levels = sorted(density['levels'], key = lambda level: level['bin_size'])
+    for level in levels:
+        if level['bin_size'] * pixels_per_metre >= min_bin_pixels and len(level['count']) <= max_density_marks:
+            return level
+    return levels[-1]
+
 ## Plotting function
-def make_plot(y_axis = 'Running_or_Chasing'):
+def make_plot(y_axis = 'Running_or_Chasing', behavior_select = False, counts = None, sightings = None, data = None):
     """
     Plot making function that contains four sub-functions to plot each of the 4 graphs in the app.
 
@@ -39,12 +294,43 @@ def make_plot(y_axis = 'Running_or_Chasing'):
     ----------
     y_axis : character
         Drop-down menu selection value for the "plot_bar_behavior" sub-function to update the behavior plot 
+    behavior_select : bool
+        If True, the behavior plot carries every behavior column and shows the
+        one picked in a select box bound to the chart, starting with "y_axis",
+        so the behavior can be switched in the browser without a new chart
+    counts : DataFrame
+        squirrel count table of a filtered view of the observations (see
+        slice_counts), joined onto the zones in the browser. If None, the
+        counts in the zones' properties (all observations) are shown.
+    sightings : dict
+        binning level of the sightings to draw on the map as a point
+        density layer (see density_level). If None, the layer is left out.
+    data : dict
+        the data files, as returned by load_data (app_data if not given)
 
     Returns
     -------
     chart
         The combined plot of the 4 sub-plots.
     """
+    import altair as alt
+    data = app_data if data is None else data
+    squirrel_json = alt.UrlData(url = data['plots_url'], format = data['plots_format'])
+
+    # Field prefix of the count columns: the zones' properties, or the
+    # top level fields added by the lookup of the filtered counts
+    p = 'properties.' if counts is None else ''
+    order = data['sort_order'] if counts is None else list(counts.sort_values(by = ['Unique_Squirrel_ID'])['sitename_short'])
+
+    def counts_chart(**kwargs):
+        # Chart of the zones, with the filtered counts looked up by sitename
+        chart = alt.Chart(squirrel_json, **kwargs)
+        if counts is None:
+            return chart
+        count_fields = [column for column in counts.columns if column not in ['sitename', 'sitename_short']]
+        return chart.transform_lookup(lookup = 'properties.sitename',
+                                      from_ = alt.LookupData(alt.InlineData(values = json.loads(counts.to_json(orient = 'records'))),
+                                                             key = 'sitename', fields = count_fields))
 
     brush = alt.selection_multi(fields = ['properties.sitename_short'],
         resolve='global')
@@ -64,14 +350,13 @@ def make_plot(y_axis = 'Running_or_Chasing'):
         )
 
         # Add Choropleth Layer
-        choropleth = (alt.Chart(squirrel_json, 
-                                title = "Central Park Squirrel Distribution: 2018 Census")
+        choropleth = (counts_chart(title = "Central Park Squirrel Distribution: 2018 Census")
         .mark_geoshape()
         .add_selection(selection)
         .encode(
         # SELECTION SINGLE CONDITIONS -- Color is grey if not selected
             color = alt.condition(selection, 
-                                'properties.Unique_Squirrel_ID:Q', 
+                                p + 'Unique_Squirrel_ID:Q', 
                                 alt.value('grey'),
                 title = 'Squirrel\nCount',
                 scale=alt.Scale(scheme='greens'),
@@ -83,32 +368,48 @@ def make_plot(y_axis = 'Running_or_Chasing'):
                                 alt.value(0.1)),
             tooltip = [alt.Tooltip('properties.sitename:N', 
                                 title="Park Region"), 
-                alt.Tooltip('properties.Unique_Squirrel_ID:Q', 
+                alt.Tooltip(p + 'Unique_Squirrel_ID:Q', 
                             title="Squirrel Count")]
         ))
         
-        return(base_map + choropleth)
+        if sightings is None:
+            return(base_map + choropleth)
+        return(base_map + choropleth + plot_sightings(sightings))
+
+    ##################################
+    # PLOT SIGHTINGS ON THE MAP
+    ##################################
+    def plot_sightings(level):
+        # One circle per bin of sightings, sized by the number of sightings
+        bins = [{'x': x, 'y': y, 'count': n} for x, y, n in zip(level['x'], level['y'], level['count'])]
+        return (alt.Chart(alt.InlineData(values = bins))
+        .mark_circle(color = 'black', opacity = 0.4)
+        .encode(
+            longitude = 'x:Q',
+            latitude = 'y:Q',
+            size = alt.Size('count:Q', scale = alt.Scale(range = [4, 80]), legend = None),
+            tooltip = [alt.Tooltip('count:Q', title = 'Sightings ({})'.format(level['name']))]
+        ))
 
 
     ##########################################
     # PLOT TOTAL SQUIRREL COUNT
     ##########################################
     def plot_bar_total_count(selection):
-        count_bar = (alt.Chart(squirrel_json, 
-                            title = 'Squirrel Count by Park Region')
+        count_bar = (counts_chart(title = 'Squirrel Count by Park Region')
         .mark_bar()
         .add_selection(selection)
         .encode(
             x = alt.X('properties.sitename_short:N',
-                sort = sort_order, 
+                sort = order, 
                 title = "Park Region", 
                 axis=alt.Axis(ticks = False,
                 titleFontSize = atfs, labels = False)),
-            y = alt.Y('properties.Unique_Squirrel_ID:Q', 
+            y = alt.Y(p + 'Unique_Squirrel_ID:Q', 
                 title = "Squirrel Count", 
                 axis = alt.Axis(labelFontSize = lfs, 
                                 titleFontSize = atfs)),
-            color = alt.Color('properties.Unique_Squirrel_ID:Q',
+            color = alt.Color(p + 'Unique_Squirrel_ID:Q',
                             scale=alt.Scale(scheme='greens'),
                             legend=None),
 
@@ -118,7 +419,7 @@ def make_plot(y_axis = 'Running_or_Chasing'):
                                     alt.value(0.2)),
             tooltip = [alt.Tooltip('properties.sitename:N', 
                                 title="Park Region"), 
-                alt.Tooltip('properties.Unique_Squirrel_ID:Q', 
+                alt.Tooltip(p + 'Unique_Squirrel_ID:Q', 
                             title="Squirrel Count")])
         .properties(width = w, height = h))   
         return(count_bar)
@@ -128,7 +429,7 @@ def make_plot(y_axis = 'Running_or_Chasing'):
     # PLOT DIFFERENCE in COUNT by TIME OF DAY
     ################################################
     def plot_bar_count_diff(selection):
-        area_count_shift = (alt.Chart(squirrel_json)
+        area_count_shift = (counts_chart()
         .mark_bar()
         .add_selection(selection)
         .encode(
@@ -138,8 +439,8 @@ def make_plot(y_axis = 'Running_or_Chasing'):
                     ticks = False,
                     title = "Park Region",
                     titleFontSize = atfs),
-                    sort = sort_order),
-            alt.Y('properties.Count_diff (AM - PM):Q', 
+                    sort = order),
+            alt.Y(p + 'Count_diff (AM - PM):Q', 
                 title = "Count Difference (AM - PM)", 
                 axis = alt.Axis(labelFontSize = lfs, 
                                 titleFontSize = atfs)),
@@ -148,12 +449,12 @@ def make_plot(y_axis = 'Running_or_Chasing'):
                                     alt.value(0.2)),
             color=alt.condition(
                 # If count is negative, color bar blue. If positive, red.
-                alt.datum['properties.Count_diff (AM - PM)'] > 0,
+                alt.datum[p + 'Count_diff (AM - PM)'] > 0,
                 alt.value("darkred"),  # The positive color
                 alt.value("steelblue")  # The negative color
             ),
             tooltip = [alt.Tooltip('properties.sitename:N', title="Park Region"), 
-                    alt.Tooltip('properties.Count_diff (AM - PM):Q', title="Count difference")]
+                    alt.Tooltip(p + 'Count_diff (AM - PM):Q', title="Count difference")]
         ).properties(title = "Squirrel Count by Park Region: AM vs. PM",
                     width = w,
                     height = h))
@@ -165,16 +466,18 @@ def make_plot(y_axis = 'Running_or_Chasing'):
     # # PLOT BEHAVIOR by PARK AREA
     # ###################################
     def plot_bar_behavior(selection, y_axis = y_axis):
-        b_chart = (alt.Chart(squirrel_json)
+        if behavior_select:
+            return plot_bar_behavior_select(selection, y_axis)
+        b_chart = (counts_chart()
             .mark_bar(color = 'gray')
             .add_selection(selection)
             .encode(alt.X('properties.sitename_short:N', 
-                    title = "Park Region", sort = sort_order, 
+                    title = "Park Region", sort = order, 
                     axis=alt.Axis(
                         labels=False,
                         titleFontSize = atfs,
                         ticks = False)), 
-                    alt.Y('properties.'+y_axis+':Q', 
+                    alt.Y(p + y_axis+':Q', 
                             title = 'Squirrel Count', 
                             axis = alt.Axis(labelFontSize = lfs,
                             titleFontSize = atfs)),
@@ -182,7 +485,7 @@ def make_plot(y_axis = 'Running_or_Chasing'):
                                         alt.value(1.0), 
                                         alt.value(0.2)),
                     tooltip = [alt.Tooltip('properties.sitename:N', title="Park Region"), 
-                            alt.Tooltip('properties.'+y_axis+':Q', title = "Count "+y_axis.replace('_',' '))]
+                            alt.Tooltip(p + y_axis+':Q', title = "Count "+y_axis.replace('_',' '))]
                 )
             .properties(title = "Squirrel Behavior by Park Region: "+y_axis.replace('_',' '),
                         width = w,
@@ -190,6 +493,45 @@ def make_plot(y_axis = 'Running_or_Chasing'):
         return b_chart
 
 
+    def plot_bar_behavior_select(selection, y_axis = y_axis):
+        # One row per park region and behavior, filtered to the behavior
+        # picked in the bound select box
+        behaviors = [option['value'] for option in behavior_options]
+        behavior = alt.selection_single(name = 'behavior',
+                                        fields = ['behavior'],
+                                        bind = alt.binding_select(options = behaviors,
+                                                                  name = 'Behavior '),
+                                        init = {'behavior': y_axis})
+        b_chart = (counts_chart()
+            .transform_calculate(**{b: 'datum.' + p + b for b in behaviors})
+            .transform_fold(behaviors, as_ = ['behavior', 'count'])
+            .transform_filter(behavior)
+            .mark_bar(color = 'gray')
+            .add_selection(selection)
+            .add_selection(behavior)
+            .encode(alt.X('properties.sitename_short:N', 
+                    title = "Park Region", sort = order, 
+                    axis=alt.Axis(
+                        labels=False,
+                        titleFontSize = atfs,
+                        ticks = False)), 
+                    alt.Y('count:Q', 
+                            title = 'Squirrel Count', 
+                            axis = alt.Axis(labelFontSize = lfs,
+                            titleFontSize = atfs)),
+                    opacity = alt.condition(brush, 
+                                        alt.value(1.0), 
+                                        alt.value(0.2)),
+                    tooltip = [alt.Tooltip('properties.sitename:N', title="Park Region"), 
+                            alt.Tooltip('behavior:N', title = "Behavior"),
+                            alt.Tooltip('count:Q', title = "Count")]
+                )
+            .properties(title = "Squirrel Behavior by Park Region",
+                        width = w,
+                        height = h))
+        return b_chart
+
+
     # Create selection conditions and link plots by setting resolve = 'global'
     brush = alt.selection_multi(fields = ['properties.sitename_short'],
         resolve='global'
@@ -216,100 +558,541 @@ def make_plot(y_axis = 'Running_or_Chasing'):
         .configure_title(fontSize = tfs, anchor = 'middle'))
                             
 
-app.layout = html.Div([
-        # First column        
-        html.Div(
-            children=[
-                html.Div(className = "app-logo", children = [
-                    html.Img(src='https://i.ibb.co/F78bQB2/logo-2.png', width = 200)
-                ]),
-                html.Div(className = "app-side-panel-intro", children = [
-                    html.H5('Guide your observance of the famous squirrels of Central Park, NY')
-                ]),
-                dcc.Markdown(className = "app-panel-list", children = [
-                    """
-                    - Hover over any chart value to see details
-                    - Click a region on any chart to highlight across all charts
-                    - Shift + click to select multiple regions at once
-                    """
-                ]),
-                html.Div(className = "app-behavior-intro", children = [
-                    html.H5('Select a Behavior to'),
-                    html.H5('Display:')
+@server.route('/data/squirrel_plots.<digest>.json')
+def serve_plots_data(digest):
+    """
+    Serves the choropleth features referenced by the charts.
+
+    The URL changes whenever the content does, so responses can be cached
+    for good. The precompressed brotli or gzip encoding is sent when the
+    browser accepts it (with a quality above 0), under its own ETag. The
+    charts load the data from a sandboxed iframe, whose requests come from
+    an opaque origin, so CORS is allowed.
+    """
+    # The chart may come from another worker that has already reloaded the
+    # data, so this worker checks the data files before the digest
+    render_cache.refresh(wait = True)
+    asset = app_data['plots_asset']
+    if digest != asset['digest']:
+        flask.abort(404)
+    encoding = 'identity'
+    for candidate in ['br', 'gzip']:
+        if candidate in asset and flask.request.accept_encodings.quality(candidate) > 0:
+            encoding = candidate
+            break
+    etag = asset['digest'] if encoding == 'identity' else '{}-{}'.format(asset['digest'], encoding)
+    headers = {'ETag': '"{}"'.format(etag),
+               'Cache-Control': 'public, max-age=31536000, immutable',
+               'Vary': 'Accept-Encoding',
+               'Access-Control-Allow-Origin': '*'}
+    if flask.request.if_none_match.contains(etag):
+        return flask.Response(status = 304, headers = headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return flask.Response(asset[encoding], mimetype = 'application/json', headers = headers)
+
+class RenderCache:
+    """
+    Bounded cache of rendered chart HTML, keyed by the view: the behavior
+    selected in the dropdown and the filters of the observations.
+
+    The data files are checked on every lookup; when either has changed on
+    disk, the data is reloaded and every cached render is dropped. The
+    reload runs outside the cache lock, by one thread at a time: lookups
+    made meanwhile are served from the data loaded before, and their
+    renders are not cached.
+
+    Parameters
+    ----------
+    render : function
+        takes a view and returns the chart HTML
+    paths : list
+        data files the renders depend on
+    reload : function
+        called to reload the data when a data file has changed. It must
+        swap in the new data as one reference.
+    maxsize : int
+        most renders to keep; the least recently used is dropped first
+    """
+
+    def __init__(self, render, paths, reload, maxsize = 8):
+        self.render = render
+        self.paths = paths
+        self.reload = reload
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.version = self.file_version()
+
+    def file_version(self):
+        """
+        Returns the modification time and size of each data file (None
+        for a missing file)
+        """
+        return tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path) else None
+                     for path in self.paths)
+
+    def refresh(self, wait = False):
+        """
+        Reloads the data if a data file has changed since it was loaded, and
+        returns the version of the data files seen. If another thread is
+        already reloading it, returns at once, or with "wait" once that
+        reload is done.
+        """
+        version = self.file_version()
+        if version == self.version:
+            return version
+        if not self.reload_lock.acquire(blocking = wait):
+            return version
+        try:
+            # Another thread may have reloaded the data while this one waited
+            version = self.file_version()
+            if version != self.version:
+                self.reload()
+                with self.lock:
+                    self.entries.clear()
+                    self.version = version
+                    self.invalidations += 1
+        finally:
+            self.reload_lock.release()
+        return version
+
+    def get(self, key):
+        """
+        Returns the chart HTML for view "key", rendering it on a miss
+        """
+        version = self.refresh()
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        html_doc = self.render(key)
+        with self.lock:
+            if version == self.version:
+                self.entries[key] = html_doc
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last = False)
+        return html_doc
+
+    def warm(self, keys):
+        """
+        Renders and caches the chart HTML for each view in "keys"
+        """
+        for key in keys:
+            self.get(key)
+
+    def stats(self):
+        """
+        Returns the cache hit, miss and invalidation counters
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'size': len(self.entries),
+                    'maxsize': self.maxsize}
+
+# Script added to the chart HTML in "client" mode: the dropdown posts the
+# selected behavior to the iframe, which sets the select box bound to the
+# chart. The select box is hidden, so the dropdown is the only behavior
+# control and the two cannot disagree.
+behavior_listener = """
+<style>.vega-bindings { display: none; }</style>
+<script>
+function selectBehavior(behavior, tries) {
+  var select = document.querySelector('.vega-bindings select');
+  if (!select) {
+    if (tries > 0) { setTimeout(function() { selectBehavior(behavior, tries - 1); }, 100); }
+    return;
+  }
+  if (select.value !== behavior) {
+    select.value = behavior;
+    select.dispatchEvent(new Event('change'));
+  }
+}
+window.addEventListener('message', function(event) {
+  if (event.data && event.data.behavior) { selectBehavior(event.data.behavior, 50); }
+});
+</script>
+"""
+
+class Histogram:
+    """
+    Prometheus style histogram of observed values, one per label value.
+
+    Each observation adds one to the count of the first bucket whose upper
+    bound it does not exceed, so recording is a bisect and two additions.
+    Counts are cumulative since start up; Prometheus takes the rate over
+    any window from successive scrapes.
+
+    Parameters
+    ----------
+    name : string
+        metric name
+    description : string
+        metric help text
+    label : string
+        name of the label telling the histograms apart
+    buckets : list
+        increasing bucket upper bounds
+    """
+
+    def __init__(self, name, description, label, buckets):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = list(buckets)
+        self.series = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        """
+        Records one observation of "value" for "label_value"
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(label_value)
+            if counts is None:
+                # One count per bucket, then the +Inf bucket and the sum
+                counts = self.series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def exposition(self):
+        """
+        Returns the histograms in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = [(label_value, list(counts)) for label_value, counts in self.series.items()]
+        for label_value, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts[:-1]):
+                total += count
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(self.name, self.label, label_value, bound, total))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(self.name, self.label, label_value, counts[-1]))
+            lines.append('{}_count{{{}="{}"}} {}'.format(self.name, self.label, label_value, total))
+        return lines
+
+latency_buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+size_buckets = [1000, 10000, 50000, 100000, 250000, 500000, 1000000, 2500000]
+
+callback_seconds = Histogram('squirrel_callback_seconds',
+                             'Wall time of Dash callback requests, by callback output',
+                             'callback', latency_buckets)
+callback_response_bytes = Histogram('squirrel_callback_response_bytes',
+                                    'Size of Dash callback responses, by callback output',
+                                    'callback', size_buckets)
+render_phase_seconds = Histogram('squirrel_render_phase_seconds',
+                                 'Wall time of each phase of a chart render',
+                                 'phase', latency_buckets)
+
+def render_plot(view):
+    """
+    Renders the chart HTML for the iframe for "view", a (behavior, filters,
+    sightings shown) tuple (see view_filters), and records the time spent
+    building the chart, serializing its spec and rendering the HTML
+    """
+    import altair as alt
+    y_axis, filters, show_sightings = view
+    render_start = time.perf_counter()
+    # Every part of the chart is built from the same data, even if it is
+    # reloaded during the render
+    data = app_data
+    counts = slice_counts(filters, data) if filters else None
+    density = data['density']
+    sightings = density_level(density) if show_sightings and density is not None else None
+    chart = make_plot(y_axis, behavior_select = plot_mode == 'client', counts = counts, sightings = sightings,
+                      data = data)
+    spec_start = time.perf_counter()
+    spec = chart.to_dict()
+    html_start = time.perf_counter()
+    plot_html = alt.utils.spec_to_html(spec, mode = 'vega-lite',
+                                       vegalite_version = alt.VEGALITE_VERSION,
+                                       vegaembed_version = alt.VEGAEMBED_VERSION,
+                                       vega_version = alt.VEGA_VERSION)
+    if plot_mode == 'client':
+        plot_html = plot_html.replace('</body>', behavior_listener + '</body>')
+    render_end = time.perf_counter()
+    render_phase_seconds.observe('chart_build', spec_start - render_start)
+    render_phase_seconds.observe('spec_serialization', html_start - spec_start)
+    render_phase_seconds.observe('html_render', render_end - html_start)
+    record_phase('first render', render_start)
+    return plot_html
+
+render_cache = RenderCache(render_plot,
+                           [count_path, plots_path, topo_path, cube_path, density_path, version_path],
+                           reload_data)
+
+def local_only(view):
+    """
+    Restricts an operational endpoint to requests made from the machine
+    the app runs on. Requests from other hosts, or passed on by a proxy
+    (with an X-Forwarded-For header), get a 404.
+    """
+    @functools.wraps(view)
+    def local_view(*args, **kwargs):
+        try:
+            loopback = ipaddress.ip_address(flask.request.remote_addr or '').is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback or 'X-Forwarded-For' in flask.request.headers:
+            flask.abort(404)
+        return view(*args, **kwargs)
+    return local_view
+
+@server.route('/render-cache')
+@local_only
+def render_cache_stats():
+    """
+    Reports the render cache counters as JSON
+    """
+    return flask.jsonify(render_cache.stats())
+
+# Callback requests slower than this many seconds are logged with a cProfile
+# report (SQUIRREL_SLOW_CALLBACK_MS, off when not set). Every callback is
+# profiled while it is on, so it is meant for tracking down outliers rather
+# than for normal use.
+slow_callback_seconds = (float(os.environ['SQUIRREL_SLOW_CALLBACK_MS']) / 1000
+                         if os.environ.get('SQUIRREL_SLOW_CALLBACK_MS') else None)
+
+@server.before_request
+def start_callback_timer():
+    """
+    Notes the start of each Dash callback request (and starts profiling it
+    when the slow callback log is on)
+    """
+    if flask.request.path != '/_dash-update-component':
+        return
+    flask.g.callback_profile = None
+    if slow_callback_seconds is not None:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            flask.g.callback_profile = profile
+        except ValueError:
+            # Another request in this process is being profiled
+            pass
+    flask.g.callback_start = time.perf_counter()
+
+@server.after_request
+def record_callback(response):
+    """
+    Records the wall time and response size of each Dash callback request,
+    labelled by the callback's output, and logs slow callbacks
+    """
+    if 'callback_start' not in flask.g:
+        return response
+    elapsed = time.perf_counter() - flask.g.callback_start
+    profile = flask.g.callback_profile
+    if profile is not None:
+        profile.disable()
+    body = flask.request.get_json(silent = True) or {}
+    callback = body.get('output', 'unknown')
+    callback_seconds.observe(callback, elapsed)
+    callback_response_bytes.observe(callback, response.calculate_content_length() or 0)
+    if profile is not None and elapsed > slow_callback_seconds:
+        report = io.StringIO()
+        pstats.Stats(profile, stream = report).sort_stats('cumulative').print_stats(25)
+        server.logger.warning('Slow callback %s: %.3fs\n%s', callback, elapsed, report.getvalue())
+    return response
+
+@server.route('/metrics')
+@local_only
+def metrics():
+    """
+    Reports callback latency and response size histograms, chart render
+    phase histograms and render cache counters in the Prometheus text format
+    """
+    lines = callback_seconds.exposition() + callback_response_bytes.exposition() + render_phase_seconds.exposition()
+    stats = render_cache.stats()
+    for counter in ['hits', 'misses', 'invalidations']:
+        lines += ['# TYPE squirrel_render_cache_{}_total counter'.format(counter),
+                  'squirrel_render_cache_{}_total {}'.format(counter, stats[counter])]
+    lines += ['# TYPE squirrel_render_cache_size gauge',
+              'squirrel_render_cache_size {}'.format(stats['size'])]
+    return flask.Response('\n'.join(lines) + '\n', mimetype = 'text/plain; version=0.0.4')
+
+def serve_layout():
+    """
+    Builds the page layout. The chart is rendered on the first page load
+    (or ahead of time by warm_up) and cached after that, rather than when
+    the app is imported.
+    """
+    plot_html = render_cache.get((default_behavior, (), False))
+    cube = app_data['cube']
+    density = app_data['density']
+    layout_start = time.perf_counter()
+    layout = html.Div([
+            # First column        
+            html.Div(
+                children=[
+                    html.Div(className = "app-logo", children = [
+                        html.Img(src='https://i.ibb.co/F78bQB2/logo-2.png', width = 200)
                     ]),
-                html.Div(className = "app-behavior-dd", children = [
-                    dcc.Dropdown(
-                        id='dd-chart',
-                        options=[
-                            {'label': 'Running or Chasing', 'value': 'Running_or_chasing'},
-                            {'label': 'Climbing', 'value': 'Climbing'},
-                            {'label': 'Eating or Foraging', 'value': 'Eating_or_foraging'},
-                            {'label': 'Vocalizing', 'value': 'Vocalizations'},
-                            {'label': 'Approaches Humans', 'value': 'Approaches'},
-                                ],
-                        value = 'Running_or_chasing',
-                        clearable = False,
-                        style=dict(width='95%',
-                                    verticalAlign="middle",
-                                    fontSize = 18
-                                    )
-                            )
+                    html.Div(className = "app-side-panel-intro", children = [
+                        html.H5('Guide your observance of the famous squirrels of Central Park, NY')
                     ]),
-                html.Div(className = "app-behavior-arrow", children = [
-                    html.Img(src="https://upload.wikimedia.org/wikipedia/commons/8/8e/Simpleicons_Interface_arrow-pointing-to-right.svg", width = 50)
-                ])
-        ], style={'width': '15%', 'display': 'inline-block', 'vertical-align': 'top'}),
-        # 2nd column
-        html.Div(className = 'app-graphs',
-                children = [
-                    html.Iframe(
-                        sandbox='allow-scripts',
-                        id='plot',
-                        height='955',
-                        width='1400',
-                        style={'border-width': '0px'},
-                        # Call plot function
-                        srcDoc = make_plot().to_html()
-                        ),
-                    html.Div(className = 'app-graph-notes-red', children = [
-                        html.P('* Red indicates more squirrels in the morning.')
+                    dcc.Markdown(className = "app-panel-list", children = [
+                        """
+                        - Hover over any chart value to see details
+                        - Click a region on any chart to highlight across all charts
+                        - Shift + click to select multiple regions at once
+                        """
+                    ]),
+                    html.Div(className = "app-behavior-intro", children = [
+                        html.H5('Select a Behavior to'),
+                        html.H5('Display:')
+                        ]),
+                    html.Div(className = "app-behavior-dd", children = [
+                        dcc.Dropdown(
+                            id='dd-chart',
+                            options=behavior_options,
+                            value = default_behavior,
+                            clearable = False,
+                            style=dict(width='95%',
+                                        verticalAlign="middle",
+                                        fontSize = 18
+                                        )
+                                )
                         ]),
-                    html.Div(className = 'app-graph-notes-blue', children = [
-                        html.P('* Blue indicates more squirrels in the afternoon')
-                        ])
-                        ], style={'width': '84%', 'display': 'inline-block'}),                 
-        # html.Div(className = 'app-graph-notes-red', children = [
-        #     html.P('* Red indicates more squirrels in the morning.')
-        #     ]),
-        # html.Div(className = 'app-graph-notes-blue', children = [
-        #     html.P('* Blue indicates more squirrels in the afternoon')
-        #     ]),
-        dcc.Markdown(className = "app-footer", children = [
-                    """
-                    #### Visit the [Github Repository](https://github.com/cgostic/squirrel_app_CG)  
-
-                    #### Sources: 
-                    - [The Central Park Squirrel Census](https://www.thesquirrelcensus.com/)
-                    - [NYC OpenData](https://data.cityofnewyork.us/Environment/2018-Central-Park-Squirrel-Census-Squirrel-Data/vfnx-vebw) 
-                    - [Squirrel Image,](https://www.trzcacak.rs/myfile/full/50-509839_squirrel-black-and-white-free-squirrel-clipart-cartoon.png) [ Arrow Image](https://commons.wikimedia.org/wiki/File:Simpleicons_Interface_arrow-pointing-to-right.svg)
+                    # Filters of the observations counted in every chart
+                    html.Div(className = "app-filters", children = [
+                        html.H5('Filter Observations:')] + [
+                        dcc.Dropdown(
+                            id = control_id,
+                            options = [] if cube is None else [{'label': filter_label(dimension, level), 'value': level}
+                                                               for level in cube['levels'][dimension]],
+                            multi = True,
+                            placeholder = placeholder,
+                            disabled = cube is None,
+                            style = dict(width = '95%',
+                                         fontSize = 14)
+                                )
+                        for dimension, control_id, placeholder in filter_controls] + [
+                        dcc.Checklist(
+                            id = 'map-layers',
+                            options = [{'label': ' Show sightings on the map', 'value': 'sightings',
+                                        'disabled': density is None}],
+                            value = [],
+                            style = dict(fontSize = 14)
+                                )
+                        ]),
+                    html.Div(className = "app-behavior-arrow", children = [
+                        html.Img(src="https://upload.wikimedia.org/wikipedia/commons/8/8e/Simpleicons_Interface_arrow-pointing-to-right.svg", width = 50)
+                    ])
+            ], style={'width': '15%', 'display': 'inline-block', 'vertical-align': 'top'}),
+            # 2nd column
+            html.Div(className = 'app-graphs',
+                    children = [
+                        html.Iframe(
+                            sandbox='allow-scripts',
+                            id='plot',
+                            height='955',
+                            width='1400',
+                            style={'border-width': '0px'},
+                            # Call plot function
+                            srcDoc = plot_html
+                            ),
+                        # Behavior shown in the chart, set by the dropdown in "client" mode
+                        html.Div(id = 'plot-behavior', style = {'display': 'none'}),
+                        html.Div(className = 'app-graph-notes-red', children = [
+                            html.P('* Red indicates more squirrels in the morning.')
+                            ]),
+                        html.Div(className = 'app-graph-notes-blue', children = [
+                            html.P('* Blue indicates more squirrels in the afternoon')
+                            ])
+                            ], style={'width': '84%', 'display': 'inline-block'}),                 
+            # html.Div(className = 'app-graph-notes-red', children = [
+            #     html.P('* Red indicates more squirrels in the morning.')
+            #     ]),
+            # html.Div(className = 'app-graph-notes-blue', children = [
+            #     html.P('* Blue indicates more squirrels in the afternoon')
+            #     ]),
+            dcc.Markdown(className = "app-footer", children = [
+                        """
+                        #### Visit the [Github Repository](https://github.com/cgostic/squirrel_app_CG)  
+
+                        #### Sources: 
+                        - [The Central Park Squirrel Census](https://www.thesquirrelcensus.com/)
+                        - [NYC OpenData](https://data.cityofnewyork.us/Environment/2018-Central-Park-Squirrel-Census-Squirrel-Data/vfnx-vebw) 
+                        - [Squirrel Image,](https://www.trzcacak.rs/myfile/full/50-509839_squirrel-black-and-white-free-squirrel-clipart-cartoon.png) [ Arrow Image](https://commons.wikimedia.org/wiki/File:Simpleicons_Interface_arrow-pointing-to-right.svg)
                     
-                    #### Contributions:  
-                    - The original version of this app was created with Roc Zhang and Lori Feng as a group project in UBC's Master of Data Science Program. The original app can be viewed [here](https://dsci-532-group203-milestone2.herokuapp.com/), and the original Github repository can be viewed [here](https://github.com/UBC-MDS/DSCI-532_group-203_Lab1-2).
-                    """
-                ])
-    ])
+                        #### Contributions:  
+                        - The original version of this app was created with Roc Zhang and Lori Feng as a group project in UBC's Master of Data Science Program. The original app can be viewed [here](https://dsci-532-group203-milestone2.herokuapp.com/), and the original Github repository can be viewed [here](https://github.com/UBC-MDS/DSCI-532_group-203_Lab1-2).
+                        """
+                    ])
+        ])
+    record_phase('layout build', layout_start)
+    return layout
 
-@app.callback(
-    dash.dependencies.Output('plot', 'srcDoc'),
-    [dash.dependencies.Input('dd-chart', 'value')])
+def warm_up():
+    """
+    Renders the charts ahead of the first page load: the default chart, and
+    in "server" mode the chart for every behavior
+    """
+    if plot_mode == 'client':
+        render_cache.warm([(default_behavior, (), False)])
+    else:
+        render_cache.warm([(option['value'], (), False) for option in behavior_options])
+    serve_layout()
 
-def update_plot(yaxis_column_name):
+@server.route('/startup')
+@local_only
+def startup_report():
+    """
+    Reports the seconds spent in each start up phase as JSON
+    """
+    return flask.jsonify(startup_times)
+
+def update_plot(yaxis_column_name, layers, *selections):
     '''
-    Takes in an xaxis_column_name and calls make_plot to update our Altair figure
+    Takes in an xaxis_column_name, the map layers ticked and the levels
+    picked in each filter dropdown and returns our Altair figure for them,
+    rendered by make_plot on the first request and cached after that
     '''
-    updated_plot = make_plot(yaxis_column_name).to_html()
+    view = (yaxis_column_name, view_filters(*selections), 'sightings' in (layers or []))
+    updated_plot = render_cache.get(view)
     return updated_plot
 
+def filter_plot(*inputs_and_behavior):
+    '''
+    Re-renders the chart when a filter or map layer changes in "client"
+    mode, starting on the behavior selected in the dropdown (the last
+    argument)
+    '''
+    *inputs, yaxis_column_name = inputs_and_behavior
+    return update_plot(yaxis_column_name, *inputs)
+
+view_inputs = ([dash.dependencies.Input('map-layers', 'value')]
+               + [dash.dependencies.Input(control_id, 'value') for _, control_id, _ in filter_controls])
+
+if plot_mode == 'client':
+    # Switch the behavior inside the chart in the browser (assets/plot_behavior.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace = 'squirrel', function_name = 'selectBehavior'),
+        dash.dependencies.Output('plot-behavior', 'children'),
+        [dash.dependencies.Input('dd-chart', 'value')])
+    # Filters and map layers are applied on the server, which renders a new chart
+    app.callback(
+        dash.dependencies.Output('plot', 'srcDoc'),
+        view_inputs,
+        [dash.dependencies.State('dd-chart', 'value')])(filter_plot)
+else:
+    app.callback(
+        dash.dependencies.Output('plot', 'srcDoc'),
+        [dash.dependencies.Input('dd-chart', 'value')] + view_inputs)(update_plot)
+
+# Set after the callbacks are registered: Dash builds a function layout to
+# check each callback against it, which would render the chart on import
+app.layout = serve_layout
 
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,14 @@
+// Clientside callbacks for app.py
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    squirrel: {
+        // Sends the behavior picked in the dropdown to the chart iframe, which
+        // switches its behavior plot without a request to the server
+        selectBehavior: function(behavior) {
+            var plot = document.getElementById('plot');
+            if (plot && plot.contentWindow) {
+                plot.contentWindow.postMessage({behavior: behavior}, '*');
+            }
+            return behavior;
+        }
+    }
+});
@@ -0,0 +1,20 @@
+# Gunicorn settings for the app (Procfile: web: gunicorn --config gunicorn.conf.py app:server)
+
+import gc
+
+# Load the app and its data once in the master process. Workers are forked
+# from it and share those pages copy-on-write instead of each loading them.
+preload_app = True
+
+def when_ready(server):
+    """
+    Renders the charts in the master before any worker is forked, so every
+    worker starts with a warm render cache, and reports the start up phases
+    """
+    import app
+    app.warm_up()
+    server.log.info('App start up: %s', ', '.join('{} {:.3f}s'.format(phase, seconds)
+                                                  for phase, seconds in app.startup_times.items()))
+    # Keep the objects created so far out of garbage collection, so the
+    # collector does not write to (and so copy) the pages shared with workers
+    gc.freeze()
@@ -0,0 +1,288 @@
+# Load packages
+
+import numpy as np
+import pandas as pd
+
+# Behavior columns of the census that are summed for each park zone
+behavior_columns = ['Running', 'Chasing', 'Climbing', 'Eating', 'Foraging',
+                    'Kuks', 'Quaas', 'Moans', 'Approaches']
+
+# Shift of an observation: AM, PM, or anything else (missing values)
+shifts = ['AM', 'PM']
+
+def shift_codes(shift):
+    """
+    Returns the index in shifts of the Shift of each observation, or
+    len(shifts) for any other value. A categorical column is coded through
+    its categories, without comparing every value.
+    """
+    if isinstance(shift.dtype, pd.CategoricalDtype):
+        lookup = np.array([shifts.index(value) if value in shifts else len(shifts)
+                           for value in shift.cat.categories] + [len(shifts)], dtype = np.int64)
+        # Code -1 (missing) picks the last entry of "lookup"
+        return lookup[shift.cat.codes.to_numpy()]
+    values = shift.to_numpy()
+    codes = np.full(len(values), len(shifts), dtype = np.int64)
+    for i, value in enumerate(shifts):
+        codes[values == value] = i
+    return codes
+
+class SiteTotals:
+    """
+    Running per-zone totals of squirrel observations.
+
+    Observations are added in batches (for example chunks of the census
+    file) and folded into fixed size arrays, so memory use depends only on
+    the number of zones, not on the number of observations. The totals give
+    the squirrel_count table written by wrangle_full.py.
+
+    Parameters
+    ----------
+    sitenames : array-like
+        sitename of each zone, in the order of the zone codes
+    """
+
+    # Observations counted at once by add
+    block_rows = 1 << 20
+
+    def __init__(self, sitenames):
+        self.sitenames = np.asarray(sitenames, dtype = object)
+        n_zones = len(self.sitenames)
+        # Observations per zone and shift (AM, PM, other)
+        self.shift_counts = np.zeros((n_zones, len(shifts) + 1), dtype = np.int64)
+        # Sum of each behavior column per zone
+        self.behavior_sums = np.zeros((n_zones, len(behavior_columns)), dtype = np.int64)
+
+    def add(self, observations):
+        """
+        Adds a batch of observations to the totals.
+
+        The zone, shift and behavior flags of each observation are packed
+        into one integer code, and every total is taken from a single
+        np.bincount of the codes: a count per zone, shift and combination
+        of behaviors, which is then summed into the shift counts and
+        behavior sums of each zone. Rows are coded in blocks of block_rows,
+        so memory use stays bounded on large censuses.
+
+        Parameters
+        ----------
+        observations : DataFrame
+            observations with a 'zone' code column (-1 for observations
+            outside every zone, which are left out), the Shift column and
+            the behavior columns, as returned by
+            wrangle_full.compact_observations
+        """
+        n_zones = len(self.sitenames)
+        n_shifts = len(shifts) + 1
+        n_patterns = 1 << len(behavior_columns)
+        codes = observations['zone'].to_numpy()
+        shift_code = shift_codes(observations['Shift'])
+        flags = [observations[column].to_numpy(dtype = bool) for column in behavior_columns]
+
+        # Observations outside every zone are counted in an extra zone
+        counts = np.zeros((n_zones + 1) * n_shifts * n_patterns, dtype = np.int64)
+        for start in range(0, len(codes), self.block_rows):
+            block = slice(start, start + self.block_rows)
+            zone = codes[block].astype(np.int64)
+            zone[zone < 0] = n_zones
+            code = (zone * n_shifts + shift_code[block]) * n_patterns
+            for bit, seen in enumerate(flags):
+                code += seen[block].astype(np.int64) << bit
+            counts += np.bincount(code, minlength = counts.size)
+        counts = counts.reshape(n_zones + 1, n_shifts, n_patterns)[:n_zones]
+
+        self.shift_counts += counts.sum(axis = 2)
+        # Behavior j was seen in the combinations with bit j set
+        patterns = np.arange(n_patterns)
+        by_pattern = counts.sum(axis = 1)
+        for bit in range(len(behavior_columns)):
+            self.behavior_sums[:, bit] += by_pattern[:, (patterns >> bit) & 1 == 1].sum(axis = 1)
+
+    def merge(self, other):
+        """
+        Adds the totals of "other", a SiteTotals over the same zones (for
+        example the totals of one shard of the census)
+        """
+        self.shift_counts += other.shift_counts
+        self.behavior_sums += other.behavior_sums
+
+    def squirrel_count(self):
+        """
+        Returns the squirrel_count table for the observations added so far:
+        one row per zone with at least one observation, sorted by sitename,
+        with the total count, behavior counts and the AM - PM difference
+        """
+        counts = self.shift_counts.sum(axis = 1)
+        zones = np.flatnonzero(counts > 0)
+        zones = zones[np.argsort(self.sitenames[zones], kind = 'stable')]
+        sums = dict(zip(behavior_columns, self.behavior_sums[zones].T))
+
+        squirrel_count = pd.DataFrame({'sitename': self.sitenames[zones],
+                                       'Unique_Squirrel_ID': counts[zones],
+                                       'Climbing': sums['Climbing'],
+                                       'Approaches': sums['Approaches'],
+                                       'Vocalizations': sums['Kuks'] + sums['Quaas'] + sums['Moans'],
+                                       'Running_or_chasing': sums['Running'] + sums['Chasing'],
+                                       'Eating_or_foraging': sums['Eating'] + sums['Foraging']})
+
+        # A zone without AM or without PM observations has no difference
+        am = self.shift_counts[zones, 0]
+        pm = self.shift_counts[zones, 1]
+        diff = am - pm
+        if ((am == 0) | (pm == 0)).any():
+            diff = np.where((am > 0) & (pm > 0), diff, np.nan)
+        squirrel_count['Count_diff (AM - PM)'] = diff
+        return squirrel_count
+
+# Dimensions of the aggregate cube, after the park zone, and its measures:
+# the number of observations and the count of each behavior
+cube_dimensions = ['Shift', 'Date', 'Age', 'Primary Fur Color']
+cube_measures = ['Unique_Squirrel_ID'] + behavior_columns
+
+class SiteCube:
+    """
+    Observation and behavior counts by park zone, shift, date, age and
+    primary fur color.
+
+    The counts are held in one integer array with an axis per dimension and
+    a last axis of measures, so any filtered view of the census is a slice
+    and a sum of the array. Observations are added in batches like
+    SiteTotals; the levels of each dimension are the values seen so far, in
+    the order they were first seen, until sort_levels is called.
+
+    Parameters
+    ----------
+    sitenames : array-like
+        sitename of each zone, in the order of the zone codes
+    """
+
+    def __init__(self, sitenames):
+        self.sitenames = np.asarray(sitenames, dtype = object)
+        self.levels = {dimension: [] for dimension in cube_dimensions}
+        self.counts = np.zeros((len(self.sitenames),) + (0,) * len(cube_dimensions) + (len(cube_measures),),
+                               dtype = np.int64)
+
+    def _level_codes(self, dimension, values):
+        """
+        Returns the level code of each value in categorical Series "values",
+        adding any new levels to "dimension" first (only the categories that
+        occur in "values")
+        """
+        axis = 1 + cube_dimensions.index(dimension)
+        levels = self.levels[dimension]
+        used = np.zeros(len(values.cat.categories), dtype = bool)
+        used[values.cat.codes.to_numpy()[values.cat.codes.to_numpy() >= 0]] = True
+        new = [value for value, is_used in zip(values.cat.categories, used)
+               if is_used and value not in levels]
+        if new:
+            levels.extend(new)
+            padding = [(0, 0)] * self.counts.ndim
+            padding[axis] = (0, len(new))
+            self.counts = np.pad(self.counts, padding)
+        category_codes = np.array([levels.index(value) if value in levels else -1
+                                   for value in values.cat.categories], dtype = np.int64)
+        return category_codes[values.cat.codes.to_numpy()]
+
+    def add(self, observations):
+        """
+        Adds a batch of observations to the cube.
+
+        Parameters
+        ----------
+        observations : DataFrame
+            observations with a 'zone' code column (-1 for observations
+            outside every zone, which are left out), the categorical cube
+            dimension columns and the behavior columns, as returned by
+            wrangle_full.compact_observations
+        """
+        found = observations['zone'].to_numpy() >= 0
+        observations = observations[found]
+        codes = [observations['zone'].to_numpy().astype(np.int64)]
+        codes += [self._level_codes(dimension, observations[dimension]) for dimension in cube_dimensions]
+        shape = self.counts.shape[:-1]
+        cell = np.ravel_multi_index(codes, shape)
+        n_cells = int(np.prod(shape))
+
+        counts = self.counts.reshape(n_cells, len(cube_measures))
+        counts[:, 0] += np.bincount(cell, minlength = n_cells)
+        for i, column in enumerate(behavior_columns):
+            counts[:, 1 + i] += np.bincount(cell[observations[column].to_numpy(dtype = bool)],
+                                            minlength = n_cells)
+
+    def merge(self, other):
+        """
+        Adds the counts of "other", a SiteCube over the same zones (for
+        example the cube of one shard of the census)
+        """
+        index = [np.arange(len(self.sitenames))]
+        for dimension in cube_dimensions:
+            values = pd.Series(other.levels[dimension], dtype = 'category')
+            index.append(self._level_codes(dimension, values))
+        self.counts[np.ix_(*index)] += other.counts
+
+    def drop_empty_levels(self):
+        """
+        Drops the levels of every dimension without any observation (for
+        example ones only seen outside every zone), so the app does not
+        offer filters that match nothing
+        """
+        for axis, dimension in enumerate(cube_dimensions, start = 1):
+            other_axes = tuple(i for i in range(self.counts.ndim - 1) if i != axis)
+            keep = np.flatnonzero(self.counts[..., 0].sum(axis = other_axes) > 0)
+            self.levels[dimension] = [self.levels[dimension][i] for i in keep]
+            self.counts = np.take(self.counts, keep, axis = axis)
+
+    def sort_levels(self):
+        """
+        Sorts the levels of every dimension, so the cube does not depend on
+        the order the observations were added in
+        """
+        for axis, dimension in enumerate(cube_dimensions, start = 1):
+            order = np.argsort(np.array(self.levels[dimension], dtype = str), kind = 'stable')
+            self.levels[dimension] = [self.levels[dimension][i] for i in order]
+            self.counts = np.take(self.counts, order, axis = axis)
+
+    def site_totals(self):
+        """
+        Returns the SiteTotals the cube adds up to
+        """
+        totals = SiteTotals(self.sitenames)
+        # Counts by zone, shift and measure
+        by_shift = self.counts.sum(axis = tuple(range(2, 1 + len(cube_dimensions))))
+        for level, shift in enumerate(self.levels['Shift']):
+            i = shifts.index(shift) if shift in shifts else len(shifts)
+            totals.shift_counts[:, i] += by_shift[:, level, 0]
+        totals.behavior_sums[:] = by_shift.sum(axis = 1)[:, 1:]
+        return totals
+
+    def check(self, squirrel_count):
+        """
+        Checks that the cube adds up to the "squirrel_count" table and raises
+        ValueError if not
+        """
+        expected = self.site_totals().squirrel_count()
+        if not expected.equals(squirrel_count[expected.columns].reset_index(drop = True)):
+            raise ValueError('The aggregate cube does not add up to the squirrel count table')
+
+    def to_arrays(self):
+        """
+        Returns the cube as a dict of arrays, as stored in squirrel_cube.npz
+        """
+        arrays = {'counts': self.counts.astype(np.int32),
+                  'sitename': np.array(self.sitenames, dtype = str),
+                  'measures': np.array(cube_measures, dtype = str),
+                  'dimensions': np.array(cube_dimensions, dtype = str)}
+        for i, dimension in enumerate(cube_dimensions):
+            arrays['levels_{}'.format(i)] = np.array(self.levels[dimension], dtype = str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Returns the cube stored in the dict of arrays "arrays" (see to_arrays)
+        """
+        cube = cls(arrays['sitename'].astype(object))
+        cube.levels = {dimension: [str(level) for level in arrays['levels_{}'.format(i)]]
+                       for i, dimension in enumerate(cube_dimensions)}
+        cube.counts = arrays['counts'].astype(np.int64)
+        return cube
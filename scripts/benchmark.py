@@ -0,0 +1,824 @@
+# Load packages
+
+import argparse
+import datetime
+import gzip
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import shapely
+import shapely.wkt
+from zones import geojson_filepath, hectare_numbers, load_zones, map_park_site, observation_xy, HectareIndex, ZoneIndex
+from synthetic import census_rows, sample_points, synthetic_census
+from wrangle_full import bin_density, choropleth, compact_observations, count_by_site, read_census, wrangle
+from topo import to_topojson
+from aggregate import SiteCube
+
+def timed(func, *args, repeat = 1, **kwargs):
+    """
+    Calls func(*args, **kwargs) "repeat" times and returns the result of the
+    last call and the fastest wall time in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def bench_spatial(args):
+    """
+    Times ZoneIndex against the point by point map_park_site loop and
+    checks that both give the same sitenames
+    """
+    gdf = load_zones(geojson_filepath)
+    index, build = timed(ZoneIndex.from_gdf, gdf)
+    print('ZoneIndex build: {:.3f}s'.format(build))
+    print('{:>6} {:>9} {:>12} {:>14} {:>9}'.format('scale', 'points', 'index (s)', 'reference (s)', 'speedup'))
+    for scale in args.scales:
+        n = int(census_rows * scale)
+        # Sample over the bounding box so some points fall outside every zone
+        x, y = sample_points(gdf, n, seed = args.seed, inside = False)
+        sitenames, t_index = timed(index.assign, x, y, repeat = args.repeat)
+        if scale > args.reference_max_scale:
+            print('{:>6} {:>9} {:>12.4f} {:>14} {:>9}'.format(scale, n, t_index, '-', '-'))
+            continue
+        points = shapely.points(x, y)
+        expected, t_ref = timed(lambda: [map_park_site(point, gdf) for point in points])
+        if list(sitenames) != expected:
+            raise AssertionError('ZoneIndex and map_park_site disagree at scale {}'.format(scale))
+        print('{:>6} {:>9} {:>12.4f} {:>14.4f} {:>8.0f}x'.format(scale, n, t_index, t_ref, t_ref / t_index))
+
+def wkt_xy(squirrel_data):
+    """
+    Coordinates of each observation by parsing the lat/long column one row
+    at a time, as wrangle_full.py used to
+    """
+    points = squirrel_data['Lat/Long'].apply(shapely.wkt.loads)
+    coords = shapely.get_coordinates(points.values)
+    return coords[:, 0], coords[:, 1]
+
+def bench_points(args):
+    """
+    Times building observation coordinates from the X/Y columns against
+    parsing the lat/long WKT column row by row
+    """
+    gdf = load_zones(geojson_filepath)
+    print('{:>6} {:>9} {:>10} {:>10} {:>9} {:>14}'.format('scale', 'rows', 'wkt (s)', 'x/y (s)',
+                                                         'speedup', 'max |diff|'))
+    for scale in args.scales:
+        census = synthetic_census(scale, seed = args.seed, gdf = gdf)
+        (wx, wy), t_wkt = timed(wkt_xy, census, repeat = args.repeat)
+        (x, y), t_xy = timed(observation_xy, census, repeat = args.repeat)
+        diff = max(np.abs(x - wx).max(), np.abs(y - wy).max())
+        print('{:>6} {:>9} {:>10.4f} {:>10.4f} {:>8.0f}x {:>14.3g}'.format(scale, len(census), t_wkt, t_xy,
+                                                                          t_wkt / t_xy, diff))
+
+def traced(func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) and returns its result, the wall time in
+    seconds and the peak memory allocated during the call in bytes
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def same_cube(cube, other):
+    """
+    Returns True if the aggregate cubes "cube" and "other" have the same
+    levels and counts
+    """
+    return cube.levels == other.levels and np.array_equal(cube.counts, other.counts)
+
+def bench_streaming(args):
+    """
+    Runs the wrangle on a synthetic census file in batch and streaming mode,
+    checks that both give the same outputs and reports time and peak memory
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'census.csv')
+        synthetic_census(args.scale, seed = args.seed).to_csv(path, index = False)
+        print('census: {} rows, {:.1f} MB'.format(int(census_rows * args.scale),
+                                                  os.path.getsize(path) / 1e6))
+        (batch_count, batch_json, batch_cube, batch_density), t_batch, m_batch = traced(wrangle, path)
+        print('{:<22} {:>8.2f}s {:>10.1f} MB peak'.format('batch', t_batch, m_batch / 1e6))
+        for chunksize in args.chunksizes:
+            (count, choro_json, cube, density), t, m = traced(wrangle, path, chunksize = chunksize)
+            if not (count.equals(batch_count) and choro_json == batch_json and same_cube(cube, batch_cube)
+                    and density == batch_density):
+                raise AssertionError('streaming output with chunksize {} differs from batch'.format(chunksize))
+            print('{:<22} {:>8.2f}s {:>10.1f} MB peak'.format('chunksize {}'.format(chunksize), t, m / 1e6))
+
+def wrangle_stages(path, gdf, index, args, scale):
+    """
+    Times each stage of the wrangle on the census at "path" and returns the
+    fastest time of each stage in seconds
+    """
+    times = {}
+    census, times['csv load'] = timed(read_census, path, repeat = args.repeat)
+    _, times['wkt parse'] = timed(wkt_xy, census, repeat = args.repeat)
+    (x, y), times['points'] = timed(observation_xy, census, repeat = args.repeat)
+    codes, times['zone assignment'] = timed(index.assign_codes, x, y, repeat = args.repeat)
+    hectares = HectareIndex.from_gdf(gdf)
+    _, times['hectare lookup'] = timed(hectares.assign_codes, x, y, census['Hectare'], index, repeat = args.repeat)
+    if scale <= args.reference_max_scale:
+        points = shapely.points(x, y)
+        _, times['map_park_site'] = timed(lambda: [map_park_site(point, gdf) for point in points])
+    observations, times['compact'] = timed(compact_observations, census, index, codes, repeat = args.repeat)
+    squirrel_count, times['aggregate'] = timed(count_by_site, observations, gdf, repeat = args.repeat)
+    def build_cube():
+        cube = SiteCube(gdf['sitename'].values)
+        cube.add(observations)
+        cube.drop_empty_levels()
+        cube.sort_levels()
+        return cube
+    _, times['cube'] = timed(build_cube, repeat = args.repeat)
+    _, times['density'] = timed(bin_density, path, gdf, repeat = args.repeat)
+    choro_json, times['geojson'] = timed(choropleth, gdf, squirrel_count, repeat = args.repeat)
+    _, times['topojson'] = timed(to_topojson, choro_json, repeat = args.repeat)
+    return times
+
+def bench_hectares(args):
+    """
+    Validation report of the hectare lookup: how many hectares and census
+    rows it resolves, and whether its zones agree with the exact
+    point.within test of map_park_site (on up to --reference-rows rows) and
+    with the ZoneIndex (on every row). Exits with an error if any row
+    disagrees.
+    """
+    gdf = load_zones(geojson_filepath)
+    hectares, t_build = timed(HectareIndex.from_gdf, gdf)
+    status = hectares.to_table(gdf['sitename'].values)['status'].value_counts()
+    print('hectares: {} inside a zone, {} outside every zone, {} on a zone boundary (built in {:.3f}s)'.format(
+        status.get('inside', 0), status.get('outside', 0), status.get('boundary', 0), t_build))
+
+    if args.source:
+        census = read_census(args.source)
+    else:
+        census = synthetic_census(args.scale, seed = args.seed, gdf = gdf)
+        census['Hectare'] = census['Hectare'].astype('category')
+    x, y = observation_xy(census)
+    index = ZoneIndex.from_gdf(gdf)
+    codes, t_lookup = timed(hectares.assign_codes, x, y, census['Hectare'], index, repeat = args.repeat)
+    expected, t_index = timed(index.assign_codes, x, y, repeat = args.repeat)
+    _, found = hectares.lookup(x, y, census['Hectare'])
+
+    numbers = hectare_numbers(census['Hectare'])
+    known = numbers >= 0
+    boundary = known & ~hectares.resolved[np.maximum(numbers, 0)]
+    n = len(census)
+    print('rows: {}'.format(n))
+    for label, count in [('resolved by hectare', found.sum()),
+                         ('hectare on a zone boundary', boundary.sum()),
+                         ('point outside its hectare', (known & ~boundary & ~found).sum()),
+                         ('missing or unknown hectare', (~known).sum())]:
+        print('  {:<28} {:>9} {:>7.1%}'.format(label, count, count / max(n, 1)))
+    print('time: {:.4f}s with the hectare lookup, {:.4f}s with the ZoneIndex alone'.format(t_lookup, t_index))
+
+    disagree_index = int((codes != expected).sum())
+    print('agreement with ZoneIndex: {}/{} rows'.format(n - disagree_index, n))
+    # The exact test is slow, so it runs on a sample of rows, weighted
+    # towards the rows the lookup resolves
+    rng = np.random.RandomState(args.seed)
+    sample = np.flatnonzero(found)
+    sample = rng.permutation(sample)[:args.reference_rows // 2]
+    rest = rng.permutation(np.flatnonzero(~found))[:args.reference_rows - len(sample)]
+    sample = np.sort(np.concatenate([sample, rest]))
+    reference = [map_park_site(point, gdf) for point in shapely.points(x[sample], y[sample])]
+    sitenames = index.sitenames_of(codes[sample])
+    disagree_exact = sum(a != b for a, b in zip(sitenames, reference))
+    print('agreement with point.within: {}/{} rows ({} resolved by hectare)'.format(
+        len(sample) - disagree_exact, len(sample), int(found[sample].sum())))
+    if disagree_index or disagree_exact:
+        sys.exit('the hectare lookup disagrees with the exact zone assignment')
+
+def groupby_count(observations, gdf):
+    """
+    Squirrel count table built with a groupby per table, as count_by_site
+    used to; kept as the reference it must match
+    """
+    observations = observations[observations['zone'] >= 0]
+    by_zone = observations.groupby('zone')
+
+    # Prepare squirrel data to graph squirrel counts by park area
+    squirrel_total_count = by_zone[['Running', 'Chasing', 'Climbing',
+                                    'Eating', 'Foraging', 'Kuks', 'Quaas',
+                                    'Moans', 'Approaches']].sum()
+    squirrel_total_count.insert(0, 'Unique_Squirrel_ID', by_zone.size())
+
+    # source (code): https://medium.com/dataexplorations/creating-choropleth-maps-in-altair-eeb7085779a1
+
+    squirrel_total_count['Vocalizations'] = squirrel_total_count['Kuks'] + squirrel_total_count['Quaas'] + squirrel_total_count['Moans']
+    squirrel_total_count['Running_or_chasing'] = squirrel_total_count['Running'] + squirrel_total_count['Chasing']
+    squirrel_total_count['Eating_or_foraging'] = squirrel_total_count['Eating'] + squirrel_total_count['Foraging']
+    squirrel_total_count = squirrel_total_count.drop(columns = ['Eating', 'Foraging', 'Running', 'Chasing', 'Kuks', 'Quaas', 'Moans'])
+
+    # Zones without AM or without PM observations get no difference
+    shift_count = observations.groupby(['zone', 'Shift'], observed = True).size().unstack()
+    squirrel_total_count['Count_diff (AM - PM)'] = shift_count['AM'] - shift_count['PM']
+
+    # Join the zone sitenames once, on the aggregated table
+    squirrel_total_count.insert(0, 'sitename', gdf['sitename'].values[squirrel_total_count.index])
+    squirrel_count = squirrel_total_count.sort_values(by = 'sitename').reset_index(drop = True)
+    return squirrel_count
+
+def bench_aggregate(args):
+    """
+    Times count_by_site against the groupby reference on observations of
+    increasing size and checks that both give the same table, with the same
+    values and dtypes
+    """
+    gdf = load_zones(geojson_filepath)
+    index = ZoneIndex.from_gdf(gdf)
+    # Observations beyond 100x the census are the 100x ones repeated
+    base_scale = min(max(args.scales), 100)
+    census = synthetic_census(base_scale, seed = args.seed, gdf = gdf)
+    for column in ['Shift', 'Date', 'Age', 'Primary Fur Color', 'Location', 'Hectare']:
+        census[column] = census[column].astype('category')
+    base = compact_observations(census, index)
+    print('{:>6} {:>10} {:>13} {:>15} {:>9}'.format('scale', 'rows', 'groupby (s)', 'single pass (s)', 'speedup'))
+    for scale in args.scales:
+        n = int(census_rows * scale)
+        observations = base.iloc[np.resize(np.arange(len(base)), n)].reset_index(drop = True)
+        expected, t_groupby = timed(groupby_count, observations, gdf, repeat = args.repeat)
+        squirrel_count, t_single = timed(count_by_site, observations, gdf, repeat = args.repeat)
+        if not (squirrel_count.equals(expected) and squirrel_count.dtypes.equals(expected.dtypes)
+                and squirrel_count.to_csv() == expected.to_csv()):
+            raise AssertionError('count_by_site differs from the groupby reference at scale {}'.format(scale))
+        print('{:>6} {:>10} {:>13.4f} {:>15.4f} {:>8.1f}x'.format(scale, n, t_groupby, t_single, t_groupby / t_single))
+
+# Times the app's render path with the data in data/, in server mode so the
+# update_plot callback runs on the server. Run in a fresh process from the
+# root of the repository.
+render_script = """
+import json, os, time
+os.environ['SQUIRREL_PLOT_MODE'] = 'server'
+import app
+
+def best(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+repeat = {repeat}
+charts = []
+times = {{'make_plot': best(lambda: charts.append(app.make_plot(app.default_behavior)), repeat)}}
+times['to_html'] = best(lambda: charts[-1].to_html(), repeat)
+
+client = app.server.test_client()
+client.get('/_dash-layout')
+def update(behavior):
+    body = {{'output': 'plot.srcDoc',
+             'inputs': [{{'id': 'dd-chart', 'property': 'value', 'value': behavior}},
+                        {{'id': 'map-layers', 'property': 'value', 'value': []}}]
+                       + [{{'id': control_id, 'property': 'value', 'value': None}}
+                          for _, control_id, _ in app.filter_controls],
+             'changedPropIds': ['dd-chart.value']}}
+    response = client.post('/_dash-update-component', json = body)
+    assert response.status_code == 200, response.status_code
+
+def update_cold():
+    app.render_cache.entries.clear()
+    update(app.default_behavior)
+times['update_plot (render)'] = best(update_cold, repeat)
+times['update_plot (cached)'] = best(lambda: update(app.default_behavior), repeat)
+if app.app_data['cube'] is not None:
+    times['slice_counts'] = best(lambda: app.slice_counts((('Age', ('Adult',)),)), repeat)
+print(json.dumps(times))
+"""
+
+def render_stages(args):
+    """
+    Times make_plot, to_html and the update_plot callback (through the Dash
+    test client) in a fresh process and returns the fastest time of each in
+    seconds
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', render_script.format(repeat = args.repeat)],
+                                     cwd = root)
+    return json.loads(output)
+
+def git_commit():
+    """
+    Returns the commit the repository is at, or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = subprocess.DEVNULL,
+                                       cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(args):
+    """
+    Times every wrangle stage on synthetic censuses and the app's render
+    path, prints the results and optionally saves them as JSON and compares
+    them with an earlier run. Runs offline.
+    """
+    gdf = load_zones(geojson_filepath)
+    index, build = timed(ZoneIndex.from_gdf, gdf)
+    results = {'commit': git_commit(),
+               'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'repeat': args.repeat,
+               'zone index build': build,
+               'wrangle': {},
+               'render': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            path = os.path.join(tmp, 'census.csv')
+            synthetic_census(scale, seed = args.seed, gdf = gdf).to_csv(path, index = False)
+            results['wrangle']['{:g}'.format(scale)] = {'rows': int(round(census_rows * scale)),
+                                              'seconds': wrangle_stages(path, gdf, index, args, scale)}
+    results['render']['seconds'] = render_stages(args)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    def report(name, seconds, before):
+        if before is None:
+            print('  {:<22} {:>10.4f}s'.format(name, seconds))
+        else:
+            print('  {:<22} {:>10.4f}s {:>10.4f}s {:>7.2f}x'.format(name, seconds, before, seconds / before))
+
+    for scale, stages in results['wrangle'].items():
+        print('wrangle, scale {} ({} rows)'.format(scale, stages['rows']))
+        before = previous['wrangle'].get(scale, {}).get('seconds', {}) if previous else {}
+        for stage, seconds in stages['seconds'].items():
+            report(stage, seconds, before.get(stage) if previous else None)
+    print('render')
+    before = previous['render'].get('seconds', {}) if previous else {}
+    for stage, seconds in results['render']['seconds'].items():
+        report(stage, seconds, before.get(stage) if previous else None)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+def bench_parallel(args):
+    """
+    Runs the wrangle on a synthetic census with 1, 2, 4 and 8 worker
+    processes, checks that each gives the same outputs as the single
+    process batch wrangle and reports the speedup
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'census.csv')
+        synthetic_census(args.scale, seed = args.seed).to_csv(path, index = False)
+        print('census: {} rows, {} rows per shard, {} cpus'.format(int(census_rows * args.scale),
+                                                                   args.shard_rows, os.cpu_count()))
+        (batch_count, batch_json, batch_cube, batch_density), t_batch = timed(wrangle, path, repeat = args.repeat)
+        print('{:<12} {:>9.3f}s'.format('batch', t_batch))
+        for workers in args.workers:
+            (count, choro_json, cube, density), t = timed(wrangle, path, chunksize = args.shard_rows,
+                                                          workers = workers, repeat = args.repeat)
+            if not (count.to_csv() == batch_count.to_csv() and json.dumps(choro_json) == json.dumps(batch_json)
+                    and same_cube(cube, batch_cube) and density == batch_density):
+                raise AssertionError('output with {} workers differs from batch'.format(workers))
+            print('{:<12} {:>9.3f}s {:>7.2f}x'.format('{} workers'.format(workers), t, t_batch / t))
+
+def peak_rss(path, chunksize = None):
+    """
+    Runs the wrangle on the census at "path" in a fresh process and returns
+    that process's peak resident set size in bytes
+    """
+    command = [sys.executable, os.path.abspath(__file__), 'rss', path]
+    if chunksize is not None:
+        command += ['--chunksize', str(chunksize)]
+    return int(subprocess.check_output(command))
+
+def bench_memory(args):
+    """
+    Reports the peak RSS of the batch and streaming wrangle on synthetic
+    censuses of increasing size
+    """
+    print('{:>6} {:>9} {:>14} {:>22}'.format('scale', 'rows', 'batch (MB)',
+                                              'chunksize {} (MB)'.format(args.chunksize)))
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            # The census is written by a separate process: a child process
+            # inherits the peak RSS of its parent on Linux
+            path = os.path.join(tmp, 'census.csv')
+            subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic.py'),
+                                   path, '--scale', str(scale), '--seed', str(args.seed)])
+            print('{:>6} {:>9} {:>14.1f} {:>22.1f}'.format(scale, int(census_rows * scale),
+                                                           peak_rss(path) / 1e6,
+                                                           peak_rss(path, args.chunksize) / 1e6))
+
+def run_rss(args):
+    """
+    Runs the wrangle once and prints the peak RSS of this process in bytes
+    (used by bench_memory)
+    """
+    wrangle(args.path, chunksize = args.chunksize)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale)
+
+# Imports the app and warms it up as gunicorn.conf.py does, then prints the
+# start up phases. Run in a fresh process from the root of the repository.
+startup_script = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.warm_up()
+print(json.dumps({'phases': app.startup_times,
+                  'import': imported - start,
+                  'ready': time.perf_counter() - start}))
+"""
+
+def bench_startup(args):
+    """
+    Times the app start up in fresh processes: importing app.py, and
+    importing it plus rendering the first chart. Exits with an error if the
+    fastest time to ready is over the budget.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [json.loads(subprocess.check_output([sys.executable, '-c', startup_script], cwd = root))
+            for _ in range(args.repeat)]
+    best = min(runs, key = lambda run: run['ready'])
+    for phase, seconds in best['phases'].items():
+        print('{:<16} {:>8.3f}s'.format(phase, seconds))
+    print('{:<16} {:>8.3f}s'.format('import', best['import']))
+    print('{:<16} {:>8.3f}s (budget {:.3f}s)'.format('ready', best['ready'], args.budget))
+    if best['ready'] > args.budget:
+        sys.exit('start up took {:.3f}s, over the budget of {:.3f}s'.format(best['ready'], args.budget))
+
+# Share of the interactions of a load test session that change each kind of
+# control: the behavior dropdown, a filter dropdown or the map layers
+interaction_weights = {'dd-chart': 6, 'filter': 3, 'map-layers': 1}
+
+class LoadClient:
+    """
+    HTTP client of one virtual user of the load test. Sends requests to the
+    app like a browser does (asking for compressed responses) and records
+    the kind, latency, status and size of each.
+    """
+
+    def __init__(self, port, records):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 120)
+        self.records = records
+
+    def request(self, kind, method, path, body = None):
+        """
+        Sends a request and returns its status (None if it failed) and
+        decoded body
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            status = response.status
+            encoding = response.getheader('Content-Encoding')
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            status, data, encoding = None, b'', None
+        self.records.append((kind, time.perf_counter() - start, status, len(data)))
+        if encoding == 'gzip':
+            data = gzip.decompress(data)
+        return status, data
+
+def layout_controls(layout):
+    """
+    Returns the props of the components of a Dash layout (as served at
+    /_dash-layout) that have an id, by id
+    """
+    controls = {}
+    stack = [layout]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, dict):
+            props = node.get('props', {})
+            if 'id' in props:
+                controls[props['id']] = props
+            stack.extend(value for value in props.values() if isinstance(value, (list, dict)))
+    return controls
+
+def load_session(client, rng, interactions, think):
+    """
+    Replays one user session: the page and its assets, the Dash layout and
+    dependencies, the zone data the chart loads, then "interactions"
+    changes of the behavior dropdown, filters and map layers, posting the
+    chart callback for each change the server handles
+    """
+    status, page = client.request('page', 'GET', '/')
+    if status != 200:
+        return
+    for path in re.findall(rb'(?:src|href)="(/[^"]+)"', page):
+        client.request('asset', 'GET', path.decode())
+    status, layout = client.request('layout', 'GET', '/_dash-layout')
+    _, dependencies = client.request('layout', 'GET', '/_dash-dependencies')
+    if status != 200:
+        return
+    for path in set(re.findall(rb'/data/squirrel_plots\.[0-9a-f]+\.json', layout)):
+        client.request('asset', 'GET', path.decode())
+
+    controls = layout_controls(json.loads(layout))
+    callback = [dependency for dependency in json.loads(dependencies)
+                if dependency['output'] == 'plot.srcDoc' and not dependency.get('clientside_function')][0]
+    values = {control_id: props.get('value') for control_id, props in controls.items()}
+    filters = [control_id for control_id, props in controls.items()
+               if control_id.startswith('filter-') and not props.get('disabled')]
+    kinds = [kind for kind in interaction_weights if kind != 'filter' or filters]
+    for _ in range(interactions):
+        time.sleep(think)
+        kind = rng.choices(kinds, [interaction_weights[kind] for kind in kinds])[0]
+        if kind == 'dd-chart':
+            control_id = 'dd-chart'
+            values[control_id] = rng.choice([option['value'] for option in controls[control_id]['options']])
+        elif kind == 'filter':
+            control_id = rng.choice(filters)
+            options = [option['value'] for option in controls[control_id]['options']]
+            values[control_id] = None if rng.random() < 0.3 else rng.sample(options, 1)
+        else:
+            control_id = 'map-layers'
+            if controls[control_id]['options'][0].get('disabled'):
+                continue
+            values[control_id] = [] if values[control_id] else ['sightings']
+        # Changes to controls that are not inputs of the chart callback are
+        # handled in the browser
+        if control_id not in [item['id'] for item in callback['inputs']]:
+            continue
+        body = {'output': callback['output'],
+                'inputs': [dict(item, value = values[item['id']]) for item in callback['inputs']],
+                'state': [dict(item, value = values[item['id']]) for item in callback['state']],
+                'changedPropIds': ['{}.value'.format(control_id)]}
+        client.request('callback', 'POST', '/_dash-update-component', body)
+
+def latency_summary(records, kind = None):
+    """
+    Returns the number, p50, p95 and p99 latency in seconds of the recorded
+    requests (of one kind, or of all kinds)
+    """
+    latencies = [latency for record_kind, latency, _, _ in records if kind is None or record_kind == kind]
+    if not latencies:
+        return {'requests': 0, 'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'requests': len(latencies), 'p50': p50, 'p95': p95, 'p99': p99}
+
+def run_load(port, users, args):
+    """
+    Runs "users" virtual users replaying sessions against the app on "port"
+    for args.duration seconds, and returns the throughput and latencies
+    """
+    records = []
+    sessions = [0]
+    stop = time.perf_counter() + args.duration
+    def user(number):
+        rng = random.Random(args.seed * 1000 + number)
+        client = LoadClient(port, records)
+        while time.perf_counter() < stop:
+            load_session(client, rng, args.interactions, args.think)
+            sessions[0] += 1
+    start = time.perf_counter()
+    threads = [threading.Thread(target = user, args = (number,)) for number in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    callbacks = latency_summary(records, 'callback')
+    return {'users': users,
+            'seconds': elapsed,
+            'sessions': sessions[0],
+            'requests per second': len(records) / elapsed,
+            'callbacks per second': callbacks['requests'] / elapsed,
+            'errors': sum(1 for _, _, status, _ in records if status is None or status >= 400),
+            'callback': callbacks,
+            'all': latency_summary(records)}
+
+def start_server(workers, threads, mode, log, root = None):
+    """
+    Starts the app with gunicorn (as the Procfile does) on a free local port
+    from the repository at "root" (this one by default) and returns the
+    process and the port once the app answers
+    """
+    root = root or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    # gunicorn's command line entry point, run by this Python
+    command = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '--config', 'gunicorn.conf.py',
+               '--workers', str(workers), '--threads', str(threads),
+               '--bind', '127.0.0.1:{}'.format(port), 'app:server']
+    process = subprocess.Popen(command, cwd = root, stdout = log, stderr = subprocess.STDOUT,
+                               env = dict(os.environ, SQUIRREL_PLOT_MODE = mode))
+    deadline = time.perf_counter() + 300
+    while time.perf_counter() < deadline and process.poll() is None:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 5)
+            connection.request('GET', '/startup')
+            if connection.getresponse().status == 200:
+                return process, port
+        except OSError:
+            time.sleep(0.5)
+    process.kill()
+    raise RuntimeError('the app did not start with {} workers and {} threads'.format(workers, threads))
+
+def bench_load(args):
+    """
+    Load tests the app under gunicorn on localhost for each number of
+    workers and threads, with an increasing number of concurrent users, and
+    prints a capacity report: throughput and latency percentiles of each
+    run, and for each server configuration the most users it serves with a
+    callback p95 latency within --slo and no errors. Optionally saves the
+    report as JSON and compares it with an earlier run.
+    """
+    results = {'commit': git_commit(),
+               'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'mode': args.mode,
+               'duration': args.duration,
+               'interactions': args.interactions,
+               'think': args.think,
+               'slo': args.slo,
+               'runs': [],
+               'capacity': {}}
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {(run['workers'], run['threads'], run['users']): run for run in json.load(f)['runs']}
+
+    def ms(seconds):
+        return '-' if seconds is None else '{:.0f}'.format(seconds * 1000)
+    print('{:>7} {:>7} {:>5} {:>8} {:>8} {:>23} {:>23} {:>6}'.format(
+        'workers', 'threads', 'users', 'req/s', 'cb/s', 'callback p50/p95/p99 ms', 'all p50/p95/p99 ms', 'errors'))
+    with tempfile.TemporaryFile() as log:
+        for workers in args.workers:
+            for threads in args.threads:
+                try:
+                    process, port = start_server(workers, threads, args.mode, log, args.app_dir)
+                except RuntimeError:
+                    log.seek(0)
+                    sys.stderr.write(log.read().decode(errors = 'replace')[-3000:])
+                    raise
+                capacity = None
+                try:
+                    for users in args.users:
+                        run = dict(run_load(port, users, args), workers = workers, threads = threads)
+                        results['runs'].append(run)
+                        line = '{:>7} {:>7} {:>5} {:>8.1f} {:>8.1f} {:>23} {:>23} {:>6}'.format(
+                            workers, threads, users, run['requests per second'], run['callbacks per second'],
+                            '/'.join(ms(run['callback'][p]) for p in ['p50', 'p95', 'p99']),
+                            '/'.join(ms(run['all'][p]) for p in ['p50', 'p95', 'p99']), run['errors'])
+                        before = previous.get((workers, threads, users))
+                        if before is not None and before['callback']['p95'] and run['callback']['p95']:
+                            line += '  (p95 {:.2f}x, req/s {:.2f}x)'.format(
+                                run['callback']['p95'] / before['callback']['p95'],
+                                run['requests per second'] / before['requests per second'])
+                        print(line, flush = True)
+                        within = run['errors'] == 0 and (run['callback']['p95'] or 0) <= args.slo
+                        if within:
+                            capacity = users
+                finally:
+                    process.terminate()
+                    process.wait()
+                results['capacity']['{} workers x {} threads'.format(workers, threads)] = capacity
+
+    print('capacity (most users with callback p95 <= {:.0f} ms and no errors):'.format(args.slo * 1000))
+    for config, users in results['capacity'].items():
+        print('  {:<24} {}'.format(config, 'under {} users'.format(min(args.users)) if users is None else
+                                   '{} users'.format(users)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the wrangle pipeline')
+    subparsers = parser.add_subparsers(dest = 'benchmark')
+    subparsers.required = True
+
+    spatial = subparsers.add_parser('spatial', help = 'zone assignment of observation points')
+    spatial.add_argument('--scales', type = float, nargs = '+', default = [1, 10, 100],
+                         help = 'point counts relative to the 2018 census (default 1 10 100)')
+    spatial.add_argument('--reference-max-scale', type = float, default = 10,
+                         help = 'largest scale to also run the point by point reference at')
+    spatial.add_argument('--repeat', type = int, default = 3)
+    spatial.add_argument('--seed', type = int, default = 0)
+    spatial.set_defaults(run = bench_spatial)
+
+    points = subparsers.add_parser('points', help = 'building observation coordinates')
+    points.add_argument('--scales', type = float, nargs = '+', default = [1, 10, 100],
+                        help = 'census sizes relative to the 2018 census (default 1 10 100)')
+    points.add_argument('--repeat', type = int, default = 3)
+    points.add_argument('--seed', type = int, default = 0)
+    points.set_defaults(run = bench_points)
+
+    streaming = subparsers.add_parser('streaming', help = 'batch against streaming wrangle')
+    streaming.add_argument('--scale', type = float, default = 10,
+                           help = 'census size relative to the 2018 census (default 10)')
+    streaming.add_argument('--chunksizes', type = int, nargs = '+', default = [1000, 10000],
+                           help = 'chunk sizes to stream with (default 1000 10000)')
+    streaming.add_argument('--seed', type = int, default = 0)
+    streaming.set_defaults(run = bench_streaming)
+
+    parallel = subparsers.add_parser('parallel', help = 'wrangle with several worker processes')
+    parallel.add_argument('--scale', type = float, default = 100,
+                          help = 'census size relative to 2018')
+    parallel.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parallel.add_argument('--shard-rows', type = int, default = 25000)
+    parallel.add_argument('--repeat', type = int, default = 1)
+    parallel.add_argument('--seed', type = int, default = 0)
+    parallel.set_defaults(run = bench_parallel)
+
+    memory = subparsers.add_parser('memory', help = 'peak RSS of the wrangle')
+    memory.add_argument('--scales', type = float, nargs = '+', default = [10, 100],
+                        help = 'census sizes relative to the 2018 census (default 10 100)')
+    memory.add_argument('--chunksize', type = int, default = 10000)
+    memory.add_argument('--seed', type = int, default = 0)
+    memory.set_defaults(run = bench_memory)
+
+    suite = subparsers.add_parser('suite', help = 'every wrangle stage and the app render path, saved as JSON')
+    suite.add_argument('--scales', type = float, nargs = '+', default = [1, 10, 100],
+                       help = 'census sizes relative to 2018 (up to 1000)')
+    suite.add_argument('--reference-max-scale', type = float, default = 1,
+                       help = 'largest scale to time the point by point map_park_site loop at')
+    suite.add_argument('--repeat', type = int, default = 3)
+    suite.add_argument('--seed', type = int, default = 0)
+    suite.add_argument('--output', help = 'JSON file to save the results to')
+    suite.add_argument('--compare', help = 'JSON results of an earlier run to compare against')
+    suite.set_defaults(run = bench_suite)
+
+    aggregate = subparsers.add_parser('aggregate', help = 'squirrel count table against the groupby reference')
+    aggregate.add_argument('--scales', type = float, nargs = '+', default = [1, 10, 100, 1000],
+                           help = 'observation counts relative to the 2018 census (default 1 10 100 1000)')
+    aggregate.add_argument('--repeat', type = int, default = 3)
+    aggregate.add_argument('--seed', type = int, default = 0)
+    aggregate.set_defaults(run = bench_aggregate)
+
+    hectare = subparsers.add_parser('hectares', help = 'validation report of the hectare lookup')
+    hectare.add_argument('--source', help = 'census CSV to check (default: a synthetic census)')
+    hectare.add_argument('--scale', type = float, default = 1,
+                         help = 'size of the synthetic census relative to 2018 (default 1)')
+    hectare.add_argument('--reference-rows', type = int, default = 3000,
+                         help = 'rows to check against the exact point.within test (default 3000)')
+    hectare.add_argument('--repeat', type = int, default = 3)
+    hectare.add_argument('--seed', type = int, default = 0)
+    hectare.set_defaults(run = bench_hectares)
+
+    startup = subparsers.add_parser('startup', help = 'app start up time')
+    startup.add_argument('--repeat', type = int, default = 3)
+    startup.add_argument('--budget', type = float, default = 3.0,
+                         help = 'maximum seconds from import to ready (default 3)')
+    startup.set_defaults(run = bench_startup)
+
+    load = subparsers.add_parser('load', help = 'concurrent users against the app under gunicorn, with a capacity report')
+    load.add_argument('--workers', type = int, nargs = '+', default = [1, 2],
+                      help = 'gunicorn worker processes to test (default 1 2)')
+    load.add_argument('--threads', type = int, nargs = '+', default = [1, 4],
+                      help = 'threads per worker to test (default 1 4)')
+    load.add_argument('--users', type = int, nargs = '+', default = [1, 4, 16],
+                      help = 'concurrent users to run against each configuration (default 1 4 16)')
+    load.add_argument('--duration', type = float, default = 20,
+                      help = 'seconds to run each number of users for (default 20)')
+    load.add_argument('--interactions', type = int, default = 8,
+                      help = 'control changes in each session after the page load (default 8)')
+    load.add_argument('--think', type = float, default = 0,
+                      help = 'seconds each user waits between control changes (default 0)')
+    load.add_argument('--mode', choices = ['server', 'client'], default = 'server',
+                      help = 'SQUIRREL_PLOT_MODE of the app (default server, where every dropdown change posts a callback)')
+    load.add_argument('--slo', type = float, default = 1.0,
+                      help = 'callback p95 latency in seconds a configuration must stay within (default 1)')
+    load.add_argument('--app-dir',
+                      help = 'checkout of the repository to run the app from, for example with a larger census in its data/ (default: this one)')
+    load.add_argument('--seed', type = int, default = 0)
+    load.add_argument('--output', help = 'JSON file to save the report to')
+    load.add_argument('--compare', help = 'JSON report of an earlier run to compare against')
+    load.set_defaults(run = bench_load)
+
+    rss = subparsers.add_parser('rss')
+    rss.add_argument('path')
+    rss.add_argument('--chunksize', type = int)
+    rss.set_defaults(run = run_rss)
+
+    args = parser.parse_args()
+    args.run(args)
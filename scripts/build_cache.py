@@ -0,0 +1,179 @@
+# Load packages
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.request
+import numpy as np
+import pandas as pd
+
+# Version of each stage of the wrangle pipeline. Bump a stage's version when
+# its code changes the stage's output: the stage and every stage downstream
+# of it are rebuilt, while the stages upstream of it are reused.
+stage_versions = {'hectares': 1,
+                  'codes': 1,
+                  'count': 2,
+                  'cube': 2,
+                  'features': 1,
+                  'topo': 1,
+                  'density': 1}
+
+def write_atomic(path, write):
+    """
+    Calls write(tmp) on a temporary file next to "path" and moves it over
+    "path", so readers see either the old or the new file, never a
+    partly written one
+    """
+    # The temporary file keeps the extension of "path": numpy adds ".npy" or
+    # ".npz" to file names without it
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)),
+                               suffix = '.tmp' + os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+class BuildCache:
+    """
+    Content-addressed store of the intermediate and final wrangle outputs.
+
+    Each stage output is stored under a key that hashes the stage's version
+    and its inputs: the content of input files, parameters, and the keys of
+    the stages it depends on. A stage whose key is already in the cache is
+    skipped, and changing an input only changes the keys of the stages
+    downstream of it.
+
+    Parameters
+    ----------
+    path : string
+        directory the cache is kept in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    @staticmethod
+    def file_digest(path):
+        """
+        Returns the sha256 hex digest of the content of the file at "path"
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(stage, *inputs):
+        """
+        Returns the cache key of "stage" given the digests, keys and
+        parameters it depends on
+        """
+        digest = hashlib.sha256()
+        for part in [stage, stage_versions[stage]] + list(inputs):
+            digest.update(repr(part).encode())
+            digest.update(b'\0')
+        return '{}-{}'.format(stage, digest.hexdigest()[:24])
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def _write(self, key, ext, write):
+        """
+        Calls write(path) on a temporary file and moves it into the cache,
+        so a stage output is never seen half written (see write_atomic)
+        """
+        write_atomic(self._file(key, ext), write)
+
+    def fetch(self, url, refresh = False):
+        """
+        Returns a local copy of the census at "url", downloading it only if
+        there is no copy in the cache yet (or "refresh" is True). Once
+        downloaded, the wrangle runs without a network connection.
+        """
+        local = self._file('census-' + hashlib.sha256(url.encode()).hexdigest()[:24], '.csv')
+        if refresh or not os.path.exists(local):
+            def download(path):
+                with urllib.request.urlopen(url) as response, open(path, 'wb') as f:
+                    shutil.copyfileobj(response, f)
+            self._write(os.path.basename(local)[:-len('.csv')], '.csv', download)
+        return local
+
+    def has(self, key, ext):
+        return os.path.exists(self._file(key, ext))
+
+    def load_array(self, key):
+        """
+        Returns the array stored under "key", or None if there is none
+        """
+        if not self.has(key, '.npy'):
+            return None
+        return np.load(self._file(key, '.npy'))
+
+    def save_array(self, key, values):
+        self._write(key, '.npy', lambda path: np.save(path, values))
+
+    def load_table(self, key):
+        """
+        Returns the DataFrame stored under "key", or None if there is none
+        """
+        if not self.has(key, '.npz'):
+            return None
+        with np.load(self._file(key, '.npz')) as stored:
+            table = pd.DataFrame()
+            for column in stored['__columns__']:
+                values = stored[column]
+                if column + '__missing' in stored.files:
+                    values = values.astype(object)
+                    values[stored[column + '__missing']] = np.nan
+                table[column] = values
+        return table
+
+    def save_table(self, key, table):
+        """
+        Stores DataFrame "table" under "key" as one array per column. Text
+        columns are stored as fixed width strings with a mask of missing
+        values.
+        """
+        arrays = {'__columns__': np.array(table.columns, dtype = str)}
+        for column in table.columns:
+            values = table[column]
+            if values.dtype.kind in 'biuf':
+                arrays[column] = values.to_numpy()
+            else:
+                arrays[column + '__missing'] = values.isna().to_numpy()
+                arrays[column] = values.fillna('').to_numpy(dtype = str)
+        self._write(key, '.npz', lambda path: np.savez(path, **arrays))
+
+    def load_arrays(self, key):
+        """
+        Returns the dict of arrays stored under "key", or None if there is none
+        """
+        if not self.has(key, '.npz'):
+            return None
+        with np.load(self._file(key, '.npz')) as stored:
+            return {name: stored[name] for name in stored.files}
+
+    def save_arrays(self, key, arrays):
+        self._write(key, '.npz', lambda path: np.savez(path, **arrays))
+
+    def load_json(self, key):
+        """
+        Returns the JSON document stored under "key", or None if there is none
+        """
+        if not self.has(key, '.json'):
+            return None
+        with open(self._file(key, '.json')) as f:
+            return json.load(f)
+
+    def save_json(self, key, document):
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(document, f)
+        self._write(key, '.json', write)
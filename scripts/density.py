@@ -0,0 +1,132 @@
+# Load packages
+
+import math
+import numpy as np
+
+# Sizes of the hexagonal bins in metres, from the centre to a corner
+hex_sizes = [25, 50, 100, 200]
+
+# Side of a census hectare in metres
+hectare_size = 100
+
+# Metres per degree of latitude (and of longitude at the equator)
+metres_per_degree = 111320.0
+
+class DensityBins:
+    """
+    Squirrel sightings counted in bins, for the point density layer of the
+    map.
+
+    Sightings are counted by census hectare (placed at the mean location of
+    its sightings) and in hexagonal bins of each size in hex_sizes, so the
+    app can show the level with a bounded number of marks rather than every
+    sighting. Sightings are added in batches, like SiteTotals.
+
+    Parameters
+    ----------
+    bounds : tuple
+        (minx, miny, maxx, maxy) bounds of the park in degrees. The hexagon
+        grids are laid out from the south west corner.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(float(bound) for bound in bounds)
+        self.lon0, self.lat0 = self.bounds[0], self.bounds[1]
+        # Metres per degree of longitude and latitude at the park
+        self.mx = metres_per_degree * math.cos(math.radians((self.bounds[1] + self.bounds[3]) / 2))
+        self.my = metres_per_degree
+        # Sightings per hexagon, keyed by its axial (q, r) coordinates
+        self.hex_counts = [{} for _ in hex_sizes]
+        # Sightings and summed coordinates per hectare
+        self.hectares = {}
+
+    def add(self, x, y, hectare):
+        """
+        Adds a batch of sightings at longitudes "x" and latitudes "y" in
+        census hectares "hectare" (sightings without a location are left out)
+        """
+        located = np.isfinite(x) & np.isfinite(y)
+        x, y = x[located], y[located]
+        hectare = np.asarray(hectare, dtype = object)[located]
+        u = (x - self.lon0) * self.mx
+        v = (y - self.lat0) * self.my
+        for counts, size in zip(self.hex_counts, hex_sizes):
+            q, r = hex_round(u / size, v / size)
+            cells, n = np.unique(np.stack([q, r], axis = 1), axis = 0, return_counts = True)
+            for (cell_q, cell_r), count in zip(cells.tolist(), n.tolist()):
+                counts[(cell_q, cell_r)] = counts.get((cell_q, cell_r), 0) + count
+
+        known = hectare == hectare
+        labels, inverse = np.unique(hectare[known].astype(str), return_inverse = True)
+        n = np.bincount(inverse, minlength = len(labels))
+        sum_x = np.bincount(inverse, weights = x[known], minlength = len(labels))
+        sum_y = np.bincount(inverse, weights = y[known], minlength = len(labels))
+        for label, count, bin_x, bin_y in zip(labels.tolist(), n.tolist(), sum_x.tolist(), sum_y.tolist()):
+            total = self.hectares.setdefault(label, [0, 0.0, 0.0])
+            total[0] += count
+            total[1] += bin_x
+            total[2] += bin_y
+
+    def merge(self, other):
+        """
+        Adds the bins of "other", DensityBins over the same bounds (for
+        example the bins of one shard of the census)
+        """
+        for counts, other_counts in zip(self.hex_counts, other.hex_counts):
+            for cell, count in other_counts.items():
+                counts[cell] = counts.get(cell, 0) + count
+        for label, (count, bin_x, bin_y) in other.hectares.items():
+            total = self.hectares.setdefault(label, [0, 0.0, 0.0])
+            total[0] += count
+            total[1] += bin_x
+            total[2] += bin_y
+
+    def hex_centre(self, q, r, size):
+        """
+        Returns the longitude and latitude of the centre of hexagon (q, r)
+        of "size" metres
+        """
+        u = size * math.sqrt(3) * (q + r / 2)
+        v = size * 1.5 * r
+        return self.lon0 + u / self.mx, self.lat0 + v / self.my
+
+    def to_json(self):
+        """
+        Returns the binned sightings as written to squirrel_density.json: the
+        park bounds, and for each level its name, bin size in metres and the
+        longitude, latitude and count of every non-empty bin
+        """
+        levels = []
+        labels = sorted(self.hectares)
+        levels.append({'name': 'hectare',
+                       'bin_size': hectare_size,
+                       'x': [round(self.hectares[label][1] / self.hectares[label][0], 6) for label in labels],
+                       'y': [round(self.hectares[label][2] / self.hectares[label][0], 6) for label in labels],
+                       'count': [self.hectares[label][0] for label in labels]})
+        for counts, size in zip(self.hex_counts, hex_sizes):
+            cells = sorted(counts)
+            centres = [self.hex_centre(q, r, size) for q, r in cells]
+            # Hexagons are sqrt(3) * size across
+            levels.append({'name': 'hex {} m'.format(size),
+                           'bin_size': round(math.sqrt(3) * size, 1),
+                           'x': [round(x, 6) for x, _ in centres],
+                           'y': [round(y, 6) for _, y in centres],
+                           'count': [counts[cell] for cell in cells]})
+        return {'bounds': list(self.bounds), 'levels': levels}
+
+def hex_round(u, v):
+    """
+    Returns the axial (q, r) coordinates of the pointy topped hexagons of
+    size 1 containing the planar points "u", "v"
+    """
+    fq = math.sqrt(3) / 3 * u - v / 3
+    fr = 2 / 3 * v
+    fs = -fq - fr
+    rq, rr, rs = np.round(fq), np.round(fr), np.round(fs)
+    dq, dr, ds = np.abs(rq - fq), np.abs(rr - fr), np.abs(rs - fs)
+    # Round to the nearest hexagon: fix the coordinate with the largest error
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
@@ -0,0 +1,223 @@
+# Load packages
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+import numpy as np
+from zones import geojson_filepath, load_zones, ZoneIndex
+from aggregate import SiteCube, SiteTotals
+from topo import default_tolerance, to_topojson
+from build_cache import BuildCache, write_atomic
+from wrangle_full import add_sitename_short, choropleth, compact_observations, read_census, read_hectares
+
+# Written around every update of the data files, so the app can tell a
+# complete set of data files from one being updated (read by app.py)
+version_file = 'squirrel_version.json'
+
+# Subdirectory of the drop directory that ingested batches are moved to
+processed_dir = 'processed'
+
+def write_json(path, document, **kwargs):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(document, f, **kwargs)
+    write_atomic(path, write)
+
+class Ingester:
+    """
+    Folds batches of new census observations into the app's data files.
+
+    The aggregate cube (squirrel_cube.npz) is the running state: only the
+    rows of a new batch are assigned to zones, and their per-zone totals and
+    cube are merged into the running totals and cube. The squirrel_count
+    table and the zone files are then rebuilt from the per-zone totals,
+    without reading the earlier observations again. The content digests
+    of the ingested batches are stored in the cube file, with the counts
+    they were added to, so a batch is never counted twice, whatever its
+    file is called.
+
+    Each update is bracketed by squirrel_version.json: it is written with
+    "writing" set before the data files are replaced, and with "writing"
+    cleared once they all are. The app reloads the data files only when it
+    reads the same finished version before and after loading them.
+
+    Parameters
+    ----------
+    data_dir : string
+        directory of the app's data files
+    geojson : string
+        filepath of the park zone geojson file
+    tolerance : float
+        simplification tolerance of the TopoJSON zones in degrees
+    hectares : string
+        if given, filepath of a hectare_zones.csv lookup to assign new
+        observations to zones by census hectare with (see
+        wrangle_full.count_squirrels)
+
+    Raises
+    ------
+    ValueError
+        if "data_dir" has a squirrel_count table but no aggregate cube
+    """
+
+    def __init__(self, data_dir = 'data', geojson = geojson_filepath, tolerance = default_tolerance,
+                 hectares = None):
+        self.data_dir = data_dir
+        self.tolerance = tolerance
+        self.gdf = load_zones(geojson)
+        self.zone_index = ZoneIndex.from_gdf(self.gdf)
+        self.hectare_index = read_hectares(hectares, self.gdf) if hectares else None
+
+        cube_path = self.path('squirrel_cube.npz')
+        self.batches = []
+        if os.path.exists(cube_path):
+            with np.load(cube_path) as stored:
+                arrays = {name: stored[name] for name in stored.files}
+            self.cube = SiteCube.from_arrays(arrays)
+            self.batches = [str(batch) for batch in arrays.get('batches', [])]
+        elif os.path.exists(self.path('squirrel_count.csv')):
+            # Without the cube the counts already in the data files are not
+            # known per shift, date, age and fur color
+            raise ValueError('{} has no squirrel_cube.npz: run wrangle_full.py first'.format(data_dir))
+        else:
+            self.cube = SiteCube(self.gdf['sitename'].values)
+        self.totals = self.cube.site_totals()
+
+        self.version = self.read_version()
+        if self.version.get('writing'):
+            # An earlier update stopped after the cube was written: the data
+            # files are rebuilt from it
+            self.write()
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def read_version(self):
+        """
+        Returns the content of squirrel_version.json ({} if there is none)
+        """
+        if not os.path.exists(self.path(version_file)):
+            return {}
+        with open(self.path(version_file)) as f:
+            return json.load(f)
+
+    def ingest(self, paths):
+        """
+        Adds the observations in the census CSV files "paths" to the data
+        files in one update, skipping files whose content was already
+        ingested. Returns the number of rows added.
+        """
+        rows = 0
+        batches = len(self.batches)
+        for path in paths:
+            digest = BuildCache.file_digest(path)
+            if digest in self.batches:
+                continue
+            observations = compact_observations(read_census(path), self.zone_index,
+                                                hectare_index = self.hectare_index)
+            batch_totals = SiteTotals(self.cube.sitenames)
+            batch_totals.add(observations)
+            batch_cube = SiteCube(self.cube.sitenames)
+            batch_cube.add(observations)
+            self.totals.merge(batch_totals)
+            self.cube.merge(batch_cube)
+            self.batches.append(digest)
+            rows += len(observations)
+        if len(self.batches) == batches:
+            return 0
+        self.cube.drop_empty_levels()
+        self.cube.sort_levels()
+        self.write()
+        return rows
+
+    def write(self):
+        """
+        Rebuilds squirrel_count.csv, squirrel_plots.json and
+        squirrel_plots.topo.json from the running totals and replaces them
+        and the cube, between the two writes of squirrel_version.json
+        """
+        squirrel_count = self.totals.squirrel_count()
+        self.cube.check(squirrel_count)
+        add_sitename_short(squirrel_count)
+        choro_json = choropleth(self.gdf, squirrel_count)
+        topo_json = to_topojson(choro_json, self.tolerance)
+
+        version = {'version': self.version.get('version', 0) + 1, 'writing': True}
+        write_json(self.path(version_file), version)
+        # The cube is written first: it holds the batches ingested, so an
+        # update that stops part way through is finished from it
+        arrays = self.cube.to_arrays()
+        arrays['batches'] = np.array(self.batches, dtype = str)
+        write_atomic(self.path('squirrel_cube.npz'), lambda tmp: np.savez_compressed(tmp, **arrays))
+        write_atomic(self.path('squirrel_count.csv'), squirrel_count.to_csv)
+        write_json(self.path('squirrel_plots.json'), choro_json)
+        write_json(self.path('squirrel_plots.topo.json'), topo_json, separators = (',', ':'))
+        version['writing'] = False
+        version['rows'] = int(squirrel_count['Unique_Squirrel_ID'].sum())
+        version['batches'] = len(self.batches)
+        write_json(self.path(version_file), version)
+        self.version = version
+
+def pending_batches(drop_dir):
+    """
+    Returns the census CSV files waiting in "drop_dir", in name order. Files
+    starting with "." are skipped, so a batch can be written under a hidden
+    name and renamed once complete.
+    """
+    return sorted(path for path in glob.glob(os.path.join(drop_dir, '*.csv')) if os.path.isfile(path))
+
+def move_processed(drop_dir, paths):
+    """
+    Moves ingested batches to the "processed" subdirectory of "drop_dir".
+    A batch named like one moved there before is renamed with a number
+    ("sightings.1.csv"), so no processed batch is overwritten.
+    """
+    os.makedirs(os.path.join(drop_dir, processed_dir), exist_ok = True)
+    for path in paths:
+        stem, ext = os.path.splitext(os.path.basename(path))
+        target = os.path.join(drop_dir, processed_dir, stem + ext)
+        number = 0
+        while os.path.exists(target):
+            number += 1
+            target = os.path.join(drop_dir, processed_dir, '{}.{}{}'.format(stem, number, ext))
+        shutil.move(path, target)
+
+def watch(ingester, drop_dir, interval = 5.0, once = False):
+    """
+    Ingests the census CSV batches dropped in "drop_dir", checking for new
+    ones every "interval" seconds (or only once)
+    """
+    while True:
+        paths = pending_batches(drop_dir)
+        if paths:
+            start = time.perf_counter()
+            rows = ingester.ingest(paths)
+            move_processed(drop_dir, paths)
+            print('ingested {} rows from {} batches in {:.2f}s (data version {})'.format(
+                rows, len(paths), time.perf_counter() - start, ingester.version.get('version')), flush = True)
+        if once:
+            return
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fold new census observation batches into the app data files')
+    parser.add_argument('drop_dir', help = 'directory watched for new census CSV batches')
+    parser.add_argument('--data-dir', default = 'data',
+                        help = 'directory of the app data files (default data)')
+    parser.add_argument('--geojson', default = geojson_filepath,
+                        help = 'filepath of the park zone geojson file')
+    parser.add_argument('--tolerance', type = float, default = default_tolerance,
+                        help = 'simplification tolerance of the TopoJSON zones in degrees (default {})'.format(default_tolerance))
+    parser.add_argument('--interval', type = float, default = 5.0,
+                        help = 'seconds between checks of the drop directory (default 5)')
+    parser.add_argument('--once', action = 'store_true',
+                        help = 'ingest the batches waiting now and exit')
+    parser.add_argument('--hectares',
+                        help = 'assign observations to zones by census hectare with this hectare_zones.csv lookup')
+    args = parser.parse_args()
+
+    watch(Ingester(args.data_dir, args.geojson, args.tolerance, args.hectares),
+          args.drop_dir, args.interval, args.once)
@@ -0,0 +1,161 @@
+# Load packages
+
+import argparse
+import numpy as np
+import pandas as pd
+import shapely
+from zones import geojson_filepath, hectare_of, load_zones, ZoneIndex
+
+# Number of observations in the 2018 census export
+census_rows = 3023
+
+# Squirrel counts by zone of the 2018 census, which synthetic observations
+# are spread over in proportion to
+count_filepath = './data/squirrel_count.csv'
+
+census_dates = [10062018, 10072018, 10082018, 10102018, 10122018, 10132018,
+                10142018, 10172018, 10182018, 10192018, 10202018]
+
+# Share of observations in each category, roughly as in the 2018 census
+# (None is a missing value)
+category_shares = {'Shift': {'AM': 0.44, 'PM': 0.56},
+                   'Age': {'Adult': 0.85, 'Juvenile': 0.11, '?': 0.002, None: 0.038},
+                   'Primary Fur Color': {'Gray': 0.82, 'Cinnamon': 0.13, 'Black': 0.03, None: 0.02},
+                   'Location': {'Ground Plane': 0.58, 'Above Ground': 0.40, None: 0.02}}
+
+# Share of observations where each behavior was seen
+behavior_shares = {'Kuks': 0.034, 'Quaas': 0.017, 'Moans': 0.001, 'Running': 0.24,
+                   'Chasing': 0.093, 'Climbing': 0.22, 'Eating': 0.25, 'Foraging': 0.47,
+                   'Approaches': 0.059, 'Indifferent': 0.48, 'Runs from': 0.22}
+
+def zone_weights(gdf, path = count_filepath):
+    """
+    Returns the share of the 2018 census observations in each zone of "gdf",
+    from the squirrel_count table at "path" (0 for zones without
+    observations)
+    """
+    counts = pd.read_csv(path).set_index('sitename')['Unique_Squirrel_ID']
+    weights = gdf['sitename'].map(counts).fillna(0).to_numpy(dtype = np.float64)
+    return weights / weights.sum()
+
+def sample_points(gdf, n, seed = 0, inside = True, weights = None):
+    """
+    Samples points uniformly over the park zones, or over each zone in
+    proportion to "weights".
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        park zones, as returned by zones.load_zones
+    n : int
+        number of points to sample
+    seed : int
+        random seed
+    inside : bool
+        if True, every point lies inside a zone. If False, points are
+        sampled over the bounding box of the zones, so some fall outside
+        every zone.
+    weights : array-like
+        if given, the share of the points sampled in each zone of "gdf".
+        The points of a zone are assigned to it by zones.ZoneIndex, so
+        zones with a weight of 0 get no points.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        float64 x (longitude) and y (latitude) of each point
+    """
+    rng = np.random.RandomState(seed)
+    minx, miny, maxx, maxy = gdf.total_bounds
+    if not inside:
+        return rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)
+
+    if weights is not None:
+        return sample_zones(gdf, n, rng, weights)
+
+    park = shapely.union_all(gdf['geometry'].values)
+    shapely.prepare(park)
+    xs, ys, found = [], [], 0
+    while found < n:
+        x = rng.uniform(minx, maxx, 2 * (n - found) + 100)
+        y = rng.uniform(miny, maxy, len(x))
+        keep = shapely.contains_xy(park, x, y)
+        xs.append(x[keep])
+        ys.append(y[keep])
+        found += keep.sum()
+    return np.concatenate(xs)[:n], np.concatenate(ys)[:n]
+
+def sample_zones(gdf, n, rng, weights):
+    """
+    Samples "n" points over the zones of "gdf" in proportion to "weights",
+    with the random state "rng" (see sample_points)
+    """
+    index = ZoneIndex.from_gdf(gdf)
+    zones = rng.choice(len(gdf), n, p = weights)
+    x = np.empty(n)
+    y = np.empty(n)
+    for zone in np.flatnonzero(np.bincount(zones, minlength = len(gdf))):
+        points = np.flatnonzero(zones == zone)
+        minx, miny, maxx, maxy = gdf['geometry'].values[zone].bounds
+        found = 0
+        while found < len(points):
+            px = rng.uniform(minx, maxx, 2 * (len(points) - found) + 100)
+            py = rng.uniform(miny, maxy, len(px))
+            keep = index.assign_codes(px, py) == zone
+            take = points[found:found + keep.sum()]
+            x[take] = px[keep][:len(take)]
+            y[take] = py[keep][:len(take)]
+            found += len(take)
+    return x, y
+
+def synthetic_census(scale = 1, seed = 0, gdf = None):
+    """
+    Generates a synthetic squirrel census with the columns of the 2018
+    census export used by wrangle_full.py.
+
+    Parameters
+    ----------
+    scale : float
+        size of the census relative to the 2018 census (3023 observations)
+    seed : int
+        random seed
+    gdf : GeoDataFrame
+        park zones to sample observation locations in, in proportion to the
+        2018 census counts of each zone (see zone_weights). Loaded from the
+        project geojson file if not given.
+
+    Returns
+    -------
+    DataFrame
+        one row per observation
+    """
+    if gdf is None:
+        gdf = load_zones(geojson_filepath)
+    n = int(round(census_rows * scale))
+    rng = np.random.RandomState(seed)
+    x, y = sample_points(gdf, n, seed = seed, weights = zone_weights(gdf))
+
+    census = pd.DataFrame({'X': x, 'Y': y})
+    census['Hectare'] = hectare_of(x, y)
+    for column, shares in category_shares.items():
+        census[column] = rng.choice(np.array(list(shares.keys()), dtype = object), n,
+                                    p = list(shares.values()))
+    census['Date'] = rng.choice(census_dates, n)
+    census['Hectare Squirrel Number'] = rng.randint(1, 24, n)
+    census['Unique Squirrel ID'] = (census['Hectare'] + '-' + census['Shift'] + '-' +
+                                    (census['Date'] // 1000000).astype(str).str.zfill(2) +
+                                    ((census['Date'] // 10000) % 100).astype(str).str.zfill(2) + '-' +
+                                    census['Hectare Squirrel Number'].astype(str).str.zfill(2))
+    for column, share in behavior_shares.items():
+        census[column] = rng.uniform(size = n) < share
+    census['Lat/Long'] = ['POINT ({!r} {!r})'.format(px, py) for px, py in zip(x.tolist(), y.tolist())]
+    return census
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write a synthetic squirrel census CSV')
+    parser.add_argument('path', help = 'CSV file to write')
+    parser.add_argument('--scale', type = float, default = 1,
+                        help = 'size relative to the 2018 census (default 1)')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    synthetic_census(args.scale, args.seed).to_csv(args.path, index = False)
@@ -0,0 +1,77 @@
+# Load packages
+
+import argparse
+import json
+import geopandas as gpd
+import topojson as tp
+
+# Name of the TopoJSON object holding the park zones (read by app.py)
+topo_object = 'zones'
+
+# Simplification tolerance in degrees. 1e-5 degrees is about 1 m, well under
+# a pixel of the 600 x 400 map.
+default_tolerance = 1e-5
+# Coordinates are quantized to a grid of this many steps across the park
+default_quantization = 1e5
+
+def to_topojson(choro_json, tolerance = default_tolerance, quantization = default_quantization):
+    """
+    Converts the choropleth feature collection to TopoJSON.
+
+    Borders shared by neighbouring zones are stored once, coordinates are
+    quantized, and the borders are simplified without breaking the topology,
+    so neighbouring zones still meet without gaps or overlaps.
+
+    Parameters
+    ----------
+    choro_json : dict
+        GeoJSON feature collection, as written to squirrel_plots.json
+    tolerance : float
+        simplification tolerance in degrees, 0 for no simplification
+    quantization : float
+        number of quantization steps across the extent of the zones
+
+    Returns
+    -------
+    dict
+        TopoJSON topology with the zones in the "zones" object
+
+    Raises
+    ------
+    ValueError
+        if any zone's geometry is invalid or empty after simplification
+    """
+    gdf = gpd.GeoDataFrame.from_features(choro_json)
+    topo = tp.Topology(gdf, prequantize = quantization, toposimplify = tolerance,
+                       object_name = topo_object)
+    check_zones(topo.to_gdf(), gdf['sitename'])
+    return topo.to_dict()
+
+def check_zones(simplified, sitenames):
+    """
+    Checks that every zone in "sitenames" has a valid, non-empty geometry in
+    the simplified GeoDataFrame "simplified", and raises ValueError if not
+    """
+    geometries = dict(zip(simplified['sitename'], simplified['geometry']))
+    bad = [sitename for sitename in sitenames
+           if sitename not in geometries
+           or geometries[sitename] is None
+           or geometries[sitename].is_empty
+           or not geometries[sitename].is_valid]
+    if bad:
+        raise ValueError('Zones without a valid geometry after simplification: {}'.format(', '.join(bad)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Convert squirrel_plots.json to simplified TopoJSON')
+    parser.add_argument('source', help = 'GeoJSON feature collection to read')
+    parser.add_argument('target', help = 'TopoJSON file to write')
+    parser.add_argument('--tolerance', type = float, default = default_tolerance,
+                        help = 'simplification tolerance in degrees (default {})'.format(default_tolerance))
+    parser.add_argument('--quantization', type = float, default = default_quantization,
+                        help = 'quantization steps across the park (default {:g})'.format(default_quantization))
+    args = parser.parse_args()
+
+    with open(args.source) as json_data:
+        choro_json = json.load(json_data)
+    with open(args.target, 'w') as topo_file:
+        json.dump(to_topojson(choro_json, args.tolerance, args.quantization), topo_file, separators = (',', ':'))
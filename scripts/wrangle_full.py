@@ -1,12 +1,18 @@
 # Load packages
 
+import argparse
+import collections
+import concurrent.futures
+import os
+import numpy as np
 import pandas as pd
 import altair as alt
-import geopandas as gpd
 import json
-from shapely.geometry import Point, Polygon
-from shapely.ops import cascaded_union
-import shapely.wkt
+from zones import geojson_filepath, load_zones, observation_xy, HectareIndex, ZoneIndex
+from aggregate import SiteCube, SiteTotals
+from topo import default_tolerance, to_topojson
+from build_cache import BuildCache
+from density import DensityBins
 
 # Need to enable this to allow work with larger datasets (https://altair-viz.github.io/user_guide/faq.html)
 alt.data_transformers.enable('json')
@@ -14,126 +20,28 @@ alt.data_transformers.enable('json')
 # source: https://automating-gis-processes.github.io/2017/lessons/L3/point-in-polygon.html
 
 url = 'https://data.cityofnewyork.us/api/views/vfnx-vebw/rows.csv'
-
-squirrel_data = pd.read_csv(url, usecols = ['X', 'Y', 'Unique Squirrel ID', 'Hectare', 'Shift', 'Date',
-       'Hectare Squirrel Number', 'Age', 'Primary Fur Color', 'Location', 'Kuks', 'Quaas', 'Moans', 'Running', 'Chasing', 'Climbing', 'Eating',
-       'Foraging', 'Approaches', 'Indifferent', 'Runs from', 'Lat/Long'])
 # source (data): https://catalog.data.gov/dataset/2018-central-park-squirrel-census-hectare-data
 
-# Replace NaN with "Unknown"
-squirrel_data = squirrel_data.fillna(value = "Unknown")
-# Convert lat/long column of squirrel data from string to point
-squirrel_data["Lat/Long"] = squirrel_data["Lat/Long"].apply(shapely.wkt.loads)
-
-# Load data needed to map data on park map
-geojson_filepath = './data/central_park_geo.geojson'
-
-def open_geojson(path):
-    """
-    Opens a geojson file at "path" filepath
-    """
-    with open(path) as json_data:
-        d = json.load(json_data)
-    return d
-
-def get_geopandas_df(path):
-    """
-    Creates geopandas dataframe from geeojson file 
-    at "path" filepath
-    """
-    open_json = open_geojson(path)
-    gdf = gpd.GeoDataFrame.from_features((open_json))
-    return gdf
-
-# Create geopandas dataframe from Central Park geoJson file
-gdf = get_geopandas_df(geojson_filepath)
+# Squirrels are counted by observation, so the 'Unique Squirrel ID' strings
+# and 'Hectare Squirrel Number' of each row are not read
+census_columns = ['X', 'Y', 'Hectare', 'Shift', 'Date',
+       'Age', 'Primary Fur Color', 'Location', 'Kuks', 'Quaas', 'Moans', 'Running', 'Chasing', 'Climbing', 'Eating',
+       'Foraging', 'Approaches', 'Indifferent', 'Runs from', 'Lat/Long']
 
-gdf.at[list(gdf.query('location == "CPW, W 97 St, West Drive, W 100 St"').index), 'sitename'] = "Central Park West (Zone 1)"
-gdf.at[list(gdf.query('location == "CPW, 85 St Transverse, West Drive To 96 St"').index), 'sitename'] = "Central Park West (Zone 2)"
-gdf.at[list(gdf.query('location == "West Drive, CPW, 65 St Transverse"').index), 'sitename'] = "Central Park West (Zone 3)"
-gdf.at[list(gdf.query('location == "66 St To 72 St, CPW To West Drive"').index), 'sitename'] = "Central Park West (Zone 4)"
+# Observation columns kept as categoricals, and behavior flags kept as bools
+category_columns = ['Hectare', 'Shift', 'Date', 'Age', 'Primary Fur Color', 'Location']
+flag_columns = ['Kuks', 'Quaas', 'Moans', 'Running', 'Chasing', 'Climbing', 'Eating',
+       'Foraging', 'Approaches', 'Indifferent', 'Runs from']
+census_dtypes = {column: 'category' for column in category_columns}
 
-# source (code): https://medium.com/dataexplorations/creating-choropleth-maps-in-altair-eeb7085779a1
-# source (map data): https://data.cityofnewyork.us/City-Government/Parks-Zones/rjaj-zgq7
+# Census columns read to bin the sightings for the point density layer
+density_columns = ['X', 'Y', 'Lat/Long', 'Hectare']
 
-# Map 'sitename' from mapping data to location of each squirrel observation
-# in 'squirrel_data'
-squirrel_data["sitename"] = "not set"
+# Rows of the census in each shard handed to a worker process, when the
+# wrangle runs with several workers and no chunksize
+shard_rows = 50000
 
-def map_park_site(point):
-    """
-    Matches point location of observation in squirrel_data to polygon
-    in gdf that it lies within. Returns "sitename" of polygon.
-    
-    Parameters
-    ----------
-    point
-        shapely.point object
-    
-    Returns
-    -------
-    string
-        sitename value of polygon that point lies within
-        
-    Examples
-    --------
-    map_park_site(Point((73, 43)))
-    > "Great Lawn"
-    -------------
-    """
-#     print(point)
-#     for poly in gdf["geometry"]:
-#         if point.within(poly):
-#             i = list(gdf['sitename'].loc[gdf['geometry'] == poly])
-#             val = i[0]
-#             return val
-    for row in range(len(gdf["geometry"])):
-        if point.within(gdf['geometry'][row]):
-            val = gdf['sitename'][row]
-            return val
-
-# Map sitename to polygons
-squirrel_data['sitename'] = squirrel_data['Lat/Long'].apply(map_park_site)
-
-squirrel_data = pd.merge(gdf, squirrel_data, on = 'sitename')
-squirrel_data.columns = [column.replace(' ', '_') for column in list(squirrel_data.columns)]
-
-# Prepare squirrel data to graph squirrel counts by park area
-squirrel_total_count = squirrel_data[['sitename','Unique_Squirrel_ID',
-                                      'Running', 'Chasing', 'Climbing', 
-                                      'Eating', 'Foraging', 'Kuks', 'Quaas',
-                                      'Moans', 'Approaches']].groupby('sitename').agg({'Unique_Squirrel_ID':'count',
-                                                                                       'Running':'sum', 
-                                                                                       'Chasing':'sum', 
-                                                                                       'Climbing':'sum',
-                                                                                       'Eating':'sum', 
-                                                                                       'Foraging':'sum', 
-                                                                                       'Kuks':'sum', 
-                                                                                       'Quaas':'sum',
-                                                                                       'Moans':'sum', 
-                                                                                       'Approaches':'sum'}).reset_index()
-
-# source (code): https://medium.com/dataexplorations/creating-choropleth-maps-in-altair-eeb7085779a1
-
-squirrel_total_count['Vocalizations'] = squirrel_total_count['Kuks'] + squirrel_total_count['Quaas'] + squirrel_total_count['Moans'] 
-#squirrel_total_count.drop(columns = ['Kuks', 'Quaas', 'Moans'])
-
-squirrel_total_count['Running_or_chasing'] = squirrel_total_count['Running'] + squirrel_total_count['Chasing']
-#squirrel_total_count.drop(columns = ['Running', 'Chasing'])
-
-squirrel_total_count['Eating_or_foraging'] = squirrel_total_count['Eating'] + squirrel_total_count['Foraging']
-squirrel_total_count = squirrel_total_count.drop(columns = ['Eating', 'Foraging', 'Running', 'Chasing', 'Kuks', 'Quaas', 'Moans'])
-
-squirrel_diff_count = squirrel_data[['sitename',
-                                      'Shift',
-                                      'Unique_Squirrel_ID',]].groupby(['sitename',
-                                                                       'Shift']).count().reset_index()
-squirrel_diff_df = squirrel_diff_count.pivot(index = 'sitename', columns = 'Shift', values = 'Unique_Squirrel_ID').reset_index()
-squirrel_diff_df['Count_diff (AM - PM)'] = squirrel_diff_df['AM'] - squirrel_diff_df['PM']
-
-squirrel_count = pd.merge(squirrel_total_count, squirrel_diff_df[['sitename','Count_diff (AM - PM)']], on = 'sitename', how = 'left')
-
-# Add shortened sitenames
+# Shortened sitenames for plot labels
 sitenames = ['Bernard Plgd',"Mariner's Gate Plgd",'The Tarr-Coyne Tots Playground','James Michael Levin Plgd',
  'Bendheim Plgd','Reservoir Running Track & Landscape','Pat Hoffman Friedman Plgd','110th St & Lenox Ave Plgd','Conservatory Garden',
  'Heckscher Plgd','Northwest Corner','Reservoir (Southeast)','Strawberry Fields',"Frawleys' Run",'The Great Hill',
@@ -154,10 +62,478 @@ sitename_short = ['Bernard Plgd', "Mariner's Gate Plgd",'T.C.T Plgd', 'J.M.L. Pl
     'N Meadow Rec. Ctr.', 'Ross Pinetum', 'Great Lawn', 'Central Park S.', 'Blockhouse One', 'Sheep Meadow', 
     'The Mall', 'N Meadow', 'The Pool', 'Bethesda Terrace', 'Hecksher Ballfields', 'The Ramble']
 
-squirrel_count['sitename_short'] = squirrel_count['sitename'].map(dict(zip(sitenames,sitename_short)))
 
-#squirrel_count.to_csv('squirrel_count.csv')
-gdf = gdf.merge(squirrel_count, left_on = 'sitename', right_on = 'sitename', how = 'inner').sort_values(by=['Unique_Squirrel_ID'])
-choro_json = json.loads(gdf.to_json())
-with open('squirrel_plots.json', 'w') as json_file:
-    json.dump(choro_json, json_file)
+def add_sitename_short(squirrel_count):
+    """
+    Adds the shortened sitename of each zone, used as its plot label, to
+    the squirrel_count table. Zones without a shortened sitename keep
+    their sitename.
+    """
+    short = squirrel_count['sitename'].map(dict(zip(sitenames, sitename_short)))
+    squirrel_count['sitename_short'] = short.fillna(squirrel_count['sitename'])
+
+def read_census(source = url, chunksize = None):
+    """
+    Reads the census columns used by the app from a local CSV file or URL.
+    With "chunksize", returns an iterator over DataFrames of that many rows.
+    """
+    return pd.read_csv(source, usecols = census_columns, dtype = census_dtypes, chunksize = chunksize)
+
+def read_hectares(path, gdf):
+    """
+    Loads the hectare lookup (HectareIndex) from a hectare_zones.csv table
+    written by an earlier run, checking that it was built from the park
+    zones "gdf" (raises ValueError if not)
+    """
+    return HectareIndex.from_table(pd.read_csv(path, dtype = {'hectare': str}), gdf['sitename'].values)
+
+def compact_observations(squirrel_data, zone_index, codes = None, hectare_index = None):
+    """
+    Maps each squirrel observation in "squirrel_data" to the park zone it
+    lies within, and keeps only the columns needed to aggregate it in a
+    compact form.
+
+    Observations carry an integer zone code rather than the zone's sitename
+    or attributes; those are joined once, on the aggregated table.
+
+    Parameters
+    ----------
+    squirrel_data : DataFrame
+        census observations, as returned by read_census
+    zone_index : ZoneIndex
+        spatial index over the park zones
+    codes : numpy.ndarray
+        zone code of each observation, if already known (for example from
+        the build cache). The spatial join is skipped when given.
+    hectare_index : HectareIndex
+        if given, observations are assigned to zones by their census
+        hectare where possible, and with "zone_index" otherwise
+
+    Returns
+    -------
+    DataFrame
+        one row per observation with the int16 'zone' code (-1 outside every
+        zone), the categorical columns with NaN replaced by "Unknown", and
+        the behavior columns as bools
+    """
+    if codes is None:
+        # Take the location of each observation from the X/Y columns, parsing the
+        # lat/long point only where X or Y is missing
+        x, y = observation_xy(squirrel_data)
+        if hectare_index is None:
+            codes = zone_index.assign_codes(x, y)
+        else:
+            codes = hectare_index.assign_codes(x, y, squirrel_data['Hectare'], zone_index)
+    observations = pd.DataFrame({'zone': np.asarray(codes).astype(np.int16)},
+                                index = squirrel_data.index)
+
+    # Replace NaN with "Unknown", adding the category only where there is a NaN
+    for column in category_columns:
+        values = squirrel_data[column].astype('category')
+        if values.isna().any():
+            if "Unknown" not in values.cat.categories:
+                values = values.cat.add_categories("Unknown")
+            values = values.fillna("Unknown")
+        observations[column] = values
+    for column in flag_columns:
+        observations[column] = squirrel_data[column].fillna(False).astype(bool)
+    return observations
+
+def count_by_site(observations, gdf):
+    """
+    Counts squirrels and behaviors by park zone, and the difference between
+    morning and afternoon counts.
+
+    Every count is taken in one pass over the zone and shift codes of the
+    observations (see SiteTotals.add), rather than with a groupby per table.
+
+    Parameters
+    ----------
+    observations : DataFrame
+        observations with a 'zone' code column, as returned by
+        compact_observations
+    gdf : GeoDataFrame
+        park zones, in zone code order
+
+    Returns
+    -------
+    DataFrame
+        squirrel_count table, one row per zone with observations, sorted
+        by sitename
+    """
+    totals = SiteTotals(gdf['sitename'].values)
+    totals.add(observations)
+    return totals.squirrel_count()
+
+# Zone index, hectare lookup, zone sitenames and density bin bounds of a
+# worker process, set once by init_worker
+worker_zone_index = None
+worker_hectare_index = None
+worker_sitenames = None
+worker_density_bounds = None
+
+def init_worker(zone_index, hectare_index, zone_sitenames, density_bounds = None):
+    """
+    Keeps the zone index, hectare lookup, sitenames and the bounds of the
+    density bins (None when the sightings are not binned) in the worker
+    process. Called once per worker, so the zone geometries are sent to
+    each worker once rather than with every shard.
+    """
+    global worker_zone_index, worker_hectare_index, worker_sitenames, worker_density_bounds
+    worker_zone_index = zone_index
+    worker_hectare_index = hectare_index
+    worker_sitenames = zone_sitenames
+    worker_density_bounds = density_bounds
+
+def bin_chunk(density, chunk):
+    """
+    Adds the sightings of a chunk of the census to the DensityBins "density"
+    """
+    x, y = observation_xy(chunk)
+    density.add(x, y, chunk['Hectare'].to_numpy())
+
+def count_shard(shard, codes = None):
+    """
+    Assigns the observations of one shard of the census to zones in a worker
+    process and returns their zone codes, per-zone totals, aggregate cube and
+    density bins (None when the sightings are not binned)
+    """
+    observations = compact_observations(shard, worker_zone_index, codes, worker_hectare_index)
+    totals = SiteTotals(worker_sitenames)
+    totals.add(observations)
+    cube = SiteCube(worker_sitenames)
+    cube.add(observations)
+    density = None
+    if worker_density_bounds is not None:
+        density = DensityBins(worker_density_bounds)
+        bin_chunk(density, shard)
+    return observations['zone'].to_numpy(), totals, cube, density
+
+def count_squirrels(source, gdf, chunksize = None, codes = None, workers = None, hectare_index = None,
+                    density = None):
+    """
+    Counts squirrels and behaviors by park zone in the census at "source",
+    and by zone, shift, date, age and fur color in an aggregate cube.
+
+    Parameters
+    ----------
+    source : string
+        local filepath or URL of the census CSV
+    gdf : GeoDataFrame
+        park zones
+    chunksize : int
+        if given, the census is streamed in chunks of this many rows and
+        folded into running per-zone totals, so memory use does not grow
+        with the size of the census. Gives the same outputs as reading
+        the whole census at once.
+    codes : numpy.ndarray
+        zone code of each observation, if already known. The spatial join
+        is skipped when given.
+    workers : int
+        if more than 1, the census is streamed in shards of "chunksize" (or
+        shard_rows) rows, and the shards are assigned to zones and totalled
+        in a pool of this many processes. The shard totals are merged in
+        census order, giving the same outputs as a single process.
+    hectare_index : HectareIndex
+        if given, lookup from census hectare to zone (see read_hectares):
+        only the observations it cannot resolve are tested against the zone
+        polygons. Every observation is tested otherwise.
+    density : DensityBins
+        if given, the sightings are also binned into it for the point
+        density layer, in the same pass over the census.
+
+    Returns
+    -------
+    tuple
+        the squirrel_count table, the aggregate cube (SiteCube), and the
+        zone code of each observation
+
+    Raises
+    ------
+    ValueError
+        if the aggregate cube does not add up to the squirrel_count table
+    """
+    zone_index = ZoneIndex.from_gdf(gdf) if codes is None else None
+    cube = SiteCube(gdf['sitename'].values)
+
+    if workers is not None and workers > 1:
+        totals = SiteTotals(gdf['sitename'].values)
+        chunk_codes = []
+        start = 0
+        # Shards waiting for a worker, at most two per worker, so memory use
+        # stays bounded by the number of workers rather than the census size
+        pending = collections.deque()
+        def collect():
+            shard_codes, shard_totals, shard_cube, shard_density = pending.popleft().result()
+            chunk_codes.append(shard_codes)
+            totals.merge(shard_totals)
+            cube.merge(shard_cube)
+            if density is not None:
+                density.merge(shard_density)
+        density_bounds = None if density is None else density.bounds
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer = init_worker,
+                                                    initargs = (zone_index, hectare_index, gdf['sitename'].values,
+                                                                density_bounds)) as pool:
+            for chunk in read_census(source, chunksize = chunksize or shard_rows):
+                pending.append(pool.submit(count_shard, chunk,
+                                           None if codes is None else codes[start:start + len(chunk)]))
+                start += len(chunk)
+                if len(pending) >= 2 * workers:
+                    collect()
+            while pending:
+                collect()
+        squirrel_count = totals.squirrel_count()
+        codes = np.concatenate(chunk_codes) if chunk_codes else np.zeros(0, dtype = np.int16)
+    elif chunksize is None:
+        census = read_census(source)
+        observations = compact_observations(census, zone_index, codes, hectare_index)
+        if density is not None:
+            bin_chunk(density, census)
+        squirrel_count = count_by_site(observations, gdf)
+        cube.add(observations)
+        codes = observations['zone'].to_numpy()
+    else:
+        totals = SiteTotals(gdf['sitename'].values)
+        chunk_codes = []
+        for chunk in read_census(source, chunksize = chunksize):
+            start = sum(len(c) for c in chunk_codes)
+            observations = compact_observations(chunk, zone_index,
+                                                None if codes is None else codes[start:start + len(chunk)],
+                                                hectare_index)
+            if density is not None:
+                bin_chunk(density, chunk)
+            totals.add(observations)
+            cube.add(observations)
+            chunk_codes.append(observations['zone'].to_numpy())
+        squirrel_count = totals.squirrel_count()
+        codes = np.concatenate(chunk_codes) if chunk_codes else np.zeros(0, dtype = np.int16)
+
+    cube.drop_empty_levels()
+    cube.sort_levels()
+    cube.check(squirrel_count)
+
+    add_sitename_short(squirrel_count)
+    return squirrel_count, cube, codes
+
+def bin_density(source, gdf, chunksize = None):
+    """
+    Bins the squirrel sightings in the census at "source" by census hectare
+    and in hexagons of several sizes over the park zones "gdf", and returns
+    the bins as written to squirrel_density.json (see DensityBins).
+    With "chunksize", the census is streamed in chunks of that many rows.
+
+    Used when the squirrel counts are already known; count_squirrels bins
+    the sightings in its own pass over the census otherwise.
+    """
+    bins = DensityBins(gdf.total_bounds)
+    chunks = pd.read_csv(source, usecols = density_columns, dtype = {'Hectare': str}, chunksize = chunksize)
+    for chunk in ([chunks] if chunksize is None else chunks):
+        bin_chunk(bins, chunk)
+    return bins.to_json()
+
+def choropleth(gdf, squirrel_count):
+    """
+    Joins the squirrel counts onto the park zones and returns them as a
+    GeoJSON feature collection, sorted by squirrel count
+    """
+    gdf = gdf.merge(squirrel_count, left_on = 'sitename', right_on = 'sitename', how = 'inner').sort_values(by=['Unique_Squirrel_ID'])
+    return json.loads(gdf.to_json())
+
+def wrangle(source = url, geojson = geojson_filepath, chunksize = None, workers = None, hectare_index = None):
+    """
+    Runs the wrangle pipeline on the census at "source".
+
+    Parameters
+    ----------
+    source : string
+        local filepath or URL of the census CSV
+    geojson : string
+        filepath of the park zone geojson file
+    chunksize : int
+        stream the census in chunks of this many rows (see count_squirrels)
+    workers : int
+        number of worker processes (see count_squirrels)
+    hectare_index : HectareIndex
+        lookup from census hectare to zone to assign observations with (see
+        count_squirrels)
+
+    Returns
+    -------
+    tuple
+        the squirrel_count table, the choropleth feature collection, the
+        aggregate cube and the binned sightings
+    """
+    # Create geopandas dataframe from Central Park geoJson file
+    gdf = load_zones(geojson)
+    density = DensityBins(gdf.total_bounds)
+    squirrel_count, cube, codes = count_squirrels(source, gdf, chunksize, workers = workers,
+                                                  hectare_index = hectare_index, density = density)
+    return squirrel_count, choropleth(gdf, squirrel_count), cube, density.to_json()
+
+def build(source = url, geojson = geojson_filepath, cache = None, chunksize = None,
+          tolerance = default_tolerance, refresh = False, workers = None, hectares = None):
+    """
+    Runs the wrangle pipeline stage by stage, reusing every stage output
+    found in the build cache.
+
+    The stages and the inputs their cache keys depend on are:
+
+    - hectares: lookup from census hectare to zone (zone geojson)
+    - codes: zone code of each observation (census, zone geojson)
+    - count: squirrel_count table (census, codes)
+    - cube: aggregate cube, built in the same pass as count (census, codes)
+    - features: choropleth feature collection (zone geojson, count)
+    - topo: simplified TopoJSON (features, tolerance)
+    - density: binned sightings for the point density layer (census, zone
+      geojson), built in the same pass over the census as count when both
+      are built
+
+    A census at a URL is downloaded into the cache once and read from there
+    afterwards, so rebuilding works offline.
+
+    Parameters
+    ----------
+    source : string
+        local filepath or URL of the census CSV
+    geojson : string
+        filepath of the park zone geojson file
+    cache : BuildCache
+        the build cache
+    chunksize : int
+        stream the census in chunks of this many rows (see count_squirrels)
+    tolerance : float
+        simplification tolerance of the TopoJSON zones in degrees
+    refresh : bool
+        download the census again even if the cache has a copy
+    workers : int
+        number of worker processes (see count_squirrels)
+    hectares : string
+        filepath of a hectare_zones.csv lookup to assign observations to
+        zones with (see read_hectares and count_squirrels)
+
+    Returns
+    -------
+    tuple
+        the squirrel_count table, the choropleth feature collection, the
+        TopoJSON topology, the aggregate cube, the binned sightings and the
+        hectare lookup table
+    """
+    if source.startswith(('http://', 'https://')):
+        source = cache.fetch(source, refresh)
+    census_digest = cache.file_digest(source)
+    zones_digest = cache.file_digest(geojson)
+    hectares_key = cache.key('hectares', zones_digest)
+    # Zone codes assigned with a hectare lookup depend on its table too
+    codes_inputs = [census_digest, zones_digest] + ([cache.file_digest(hectares)] if hectares else [])
+    codes_key = cache.key('codes', *codes_inputs)
+    count_key = cache.key('count', census_digest, codes_key)
+    cube_key = cache.key('cube', census_digest, codes_key)
+    features_key = cache.key('features', zones_digest, count_key)
+    topo_key = cache.key('topo', features_key, tolerance)
+    density_key = cache.key('density', census_digest, zones_digest)
+
+    # Create geopandas dataframe from Central Park geoJson file
+    gdf = load_zones(geojson)
+    hectare_index = read_hectares(hectares, gdf) if hectares else None
+
+    hectare_table = cache.load_table(hectares_key)
+    print('hectares: {}'.format('reused' if hectare_table is not None else 'building'))
+    if hectare_table is None:
+        hectare_table = HectareIndex.from_gdf(gdf).to_table(gdf['sitename'].values)
+        cache.save_table(hectares_key, hectare_table)
+
+    density_json = cache.load_json(density_key)
+    density_reused = density_json is not None
+    squirrel_count = cache.load_table(count_key)
+    cube_arrays = cache.load_arrays(cube_key)
+    if squirrel_count is None or cube_arrays is None:
+        codes = cache.load_array(codes_key)
+        print('codes: {}'.format('reused' if codes is not None else 'building'))
+        print('count: building')
+        print('cube: building')
+        # The sightings are binned in the same pass over the census
+        density = DensityBins(gdf.total_bounds) if density_json is None else None
+        squirrel_count, cube, codes = count_squirrels(source, gdf, chunksize, codes, workers,
+                                                      hectare_index, density)
+        cache.save_array(codes_key, codes)
+        cache.save_table(count_key, squirrel_count)
+        cache.save_arrays(cube_key, cube.to_arrays())
+        if density is not None:
+            density_json = density.to_json()
+            cache.save_json(density_key, density_json)
+    else:
+        print('count: reused')
+        print('cube: reused')
+        cube = SiteCube.from_arrays(cube_arrays)
+
+    choro_json = cache.load_json(features_key)
+    print('features: {}'.format('reused' if choro_json is not None else 'building'))
+    if choro_json is None:
+        choro_json = choropleth(gdf, squirrel_count)
+        cache.save_json(features_key, choro_json)
+
+    topo_json = cache.load_json(topo_key)
+    print('topo: {}'.format('reused' if topo_json is not None else 'building'))
+    if topo_json is None:
+        topo_json = to_topojson(choro_json, tolerance)
+        cache.save_json(topo_key, topo_json)
+
+    print('density: {}'.format('reused' if density_reused else 'building'))
+    if density_json is None:
+        density_json = bin_density(source, gdf, chunksize)
+        cache.save_json(density_key, density_json)
+    return squirrel_count, choro_json, topo_json, cube, density_json, hectare_table
+
+def write_outputs(squirrel_count, choro_json, topo_json, cube, density_json, hectare_table, out_dir = '.'):
+    """
+    Writes squirrel_count.csv, squirrel_plots.json, its simplified TopoJSON
+    version squirrel_plots.topo.json, the aggregate cube squirrel_cube.npz,
+    the binned sightings squirrel_density.json and the hectare lookup
+    hectare_zones.csv to "out_dir"
+    """
+    squirrel_count.to_csv(os.path.join(out_dir, 'squirrel_count.csv'))
+    with open(os.path.join(out_dir, 'squirrel_plots.json'), 'w') as json_file:
+        json.dump(choro_json, json_file)
+    with open(os.path.join(out_dir, 'squirrel_plots.topo.json'), 'w') as topo_file:
+        json.dump(topo_json, topo_file, separators = (',', ':'))
+    np.savez_compressed(os.path.join(out_dir, 'squirrel_cube.npz'), **cube.to_arrays())
+    with open(os.path.join(out_dir, 'squirrel_density.json'), 'w') as density_file:
+        json.dump(density_json, density_file, separators = (',', ':'))
+    hectare_table.to_csv(os.path.join(out_dir, 'hectare_zones.csv'), index = False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Transform the squirrel census into the data files used by the app')
+    parser.add_argument('--source', default = url,
+                        help = 'filepath or URL of the census CSV (default: NYC OpenData)')
+    parser.add_argument('--geojson', default = geojson_filepath,
+                        help = 'filepath of the park zone geojson file')
+    parser.add_argument('--chunksize', type = int,
+                        help = 'stream the census in chunks of this many rows')
+    parser.add_argument('--workers', type = int,
+                        help = 'assign and count shards of the census in this many worker processes')
+    parser.add_argument('--out-dir', default = '.',
+                        help = 'directory to write squirrel_count.csv, squirrel_plots.json, squirrel_plots.topo.json, squirrel_cube.npz, squirrel_density.json and hectare_zones.csv to')
+    parser.add_argument('--tolerance', type = float, default = default_tolerance,
+                        help = 'simplification tolerance of the TopoJSON zones in degrees (default {})'.format(default_tolerance))
+    parser.add_argument('--cache-dir', default = '.wrangle_cache',
+                        help = 'directory of the build cache (default .wrangle_cache)')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'run every stage without reading or writing the build cache')
+    parser.add_argument('--refresh', action = 'store_true',
+                        help = 'download the census again even if the build cache has a copy')
+    parser.add_argument('--hectares',
+                        help = 'assign observations to zones by census hectare with this hectare_zones.csv lookup, written by an earlier run')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        gdf = load_zones(args.geojson)
+        hectare_index = read_hectares(args.hectares, gdf) if args.hectares else None
+        squirrel_count, choro_json, cube, density_json = wrangle(args.source, args.geojson, args.chunksize,
+                                                                 args.workers, hectare_index)
+        topo_json = to_topojson(choro_json, args.tolerance)
+        hectare_table = HectareIndex.from_gdf(gdf).to_table(gdf['sitename'].values)
+    else:
+        squirrel_count, choro_json, topo_json, cube, density_json, hectare_table = build(
+            args.source, args.geojson, BuildCache(args.cache_dir),
+            args.chunksize, args.tolerance, args.refresh, args.workers, args.hectares)
+    write_outputs(squirrel_count, choro_json, topo_json, cube, density_json, hectare_table, args.out_dir)
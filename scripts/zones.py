@@ -0,0 +1,489 @@
+# Load packages
+
+import json
+import re
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.strtree import STRtree
+
+# Load data needed to map data on park map
+geojson_filepath = './data/central_park_geo.geojson'
+
+# The four Central Park West zones share a sitename in the NYC Parks data,
+# so they are told apart by their "location" description
+cpw_zones = {"CPW, W 97 St, West Drive, W 100 St": "Central Park West (Zone 1)",
+             "CPW, 85 St Transverse, West Drive To 96 St": "Central Park West (Zone 2)",
+             "West Drive, CPW, 65 St Transverse": "Central Park West (Zone 3)",
+             "66 St To 72 St, CPW To West Drive": "Central Park West (Zone 4)"}
+
+# Approximate corners of the census hectare grid (59th St to 110th St,
+# Central Park West to 5th Ave). Rows 01-42 run south to north and
+# columns A-I run west to east.
+grid_sw = np.array([-73.9817, 40.7682])
+grid_se = np.array([-73.9730, 40.7644])
+grid_nw = np.array([-73.9581, 40.8005])
+grid_rows = 42
+grid_cols = 9
+grid_letters = 'ABCDEFGHI'
+
+def open_geojson(path):
+    """
+    Opens a geojson file at "path" filepath
+    """
+    with open(path) as json_data:
+        d = json.load(json_data)
+    return d
+
+def get_geopandas_df(path):
+    """
+    Creates geopandas dataframe from geeojson file
+    at "path" filepath
+    """
+    open_json = open_geojson(path)
+    gdf = gpd.GeoDataFrame.from_features((open_json))
+    return gdf
+
+def load_zones(path = geojson_filepath):
+    """
+    Creates the Central Park zone geopandas dataframe from the geojson file
+    at "path" filepath, with the Central Park West zones given unique sitenames.
+
+    Parameters
+    ----------
+    path : string
+        filepath of the zone geojson file
+
+    Returns
+    -------
+    GeoDataFrame
+        one row per park zone, in the order of the geojson features
+    """
+    gdf = get_geopandas_df(path)
+    for location, sitename in cpw_zones.items():
+        gdf.loc[gdf['location'] == location, 'sitename'] = sitename
+    # source (code): https://medium.com/dataexplorations/creating-choropleth-maps-in-altair-eeb7085779a1
+    # source (map data): https://data.cityofnewyork.us/City-Government/Parks-Zones/rjaj-zgq7
+    return gdf
+
+def observation_xy(squirrel_data, x = 'X', y = 'Y', wkt = 'Lat/Long'):
+    """
+    Returns the coordinates of each observation as contiguous float64 arrays.
+
+    Coordinates are taken from the numeric "x" and "y" columns in one batch.
+    The WKT point in the "wkt" column is parsed only for rows where "x" or
+    "y" is missing. Rows without any usable location get NaN, which
+    ZoneIndex leaves unassigned.
+
+    Parameters
+    ----------
+    squirrel_data : DataFrame
+        census observations, before missing values are filled in
+    x, y, wkt : string
+        names of the longitude, latitude and WKT point columns
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        float64 x (longitude) and y (latitude) of each observation
+    """
+    xs = np.array(pd.to_numeric(squirrel_data[x], errors = 'coerce'), dtype = np.float64)
+    ys = np.array(pd.to_numeric(squirrel_data[y], errors = 'coerce'), dtype = np.float64)
+    missing = np.flatnonzero(np.isnan(xs) | np.isnan(ys))
+    if len(missing) > 0 and wkt in squirrel_data:
+        text = squirrel_data[wkt].to_numpy(dtype = object)[missing]
+        text = np.where(pd.isna(text), None, text)
+        points = shapely.from_wkt(text, on_invalid = 'ignore')
+        is_point = shapely.get_type_id(points) == 0
+        xs[missing] = np.where(is_point, shapely.get_x(points), np.nan)
+        ys[missing] = np.where(is_point, shapely.get_y(points), np.nan)
+    return xs, ys
+
+def map_park_site(point, gdf):
+    """
+    Matches point location of observation in squirrel_data to polygon
+    in gdf that it lies within. Returns "sitename" of polygon.
+
+    This is the exact, one point at a time reference that ZoneIndex
+    reproduces; it is kept for validation and benchmarking.
+
+    Parameters
+    ----------
+    point
+        shapely.point object
+    gdf
+        GeoDataFrame of park zones, as returned by load_zones
+
+    Returns
+    -------
+    string
+        sitename value of polygon that point lies within
+
+    Examples
+    --------
+    map_park_site(Point((73, 43)), gdf)
+    > "Great Lawn"
+    -------------
+    """
+    for row in range(len(gdf["geometry"])):
+        if point.within(gdf['geometry'][row]):
+            val = gdf['sitename'][row]
+            return val
+
+class ZoneIndex:
+    """
+    Grid index over the park zone polygons for assigning many points to
+    zones at once.
+
+    The bounding box of the zones is split into a regular grid of cells.
+    An STR-tree over the zone polygons is queried once per cell to find the
+    zones that touch it, and cells that lie strictly inside a single zone
+    (with no earlier zone touching them) are resolved without any geometry
+    test. Points in the remaining cells are tested with vectorized
+    containment tests, only against the zones that touch their cell.
+
+    Assignment follows the same rules as map_park_site:
+
+    - zones overlap in a few places, so a point takes the first zone,
+      in row order, that contains it
+    - a point must lie strictly inside a zone; points on a zone boundary
+      and not inside any other zone are left unassigned
+    - points outside every zone, or with missing coordinates, are left
+      unassigned (code -1, sitename None)
+    """
+
+    # Cells are padded so that floating point rounding in the cell
+    # arithmetic can never put a point outside the cell it is tested against
+    _cell_pad = 1e-9
+
+    def __init__(self, geometries, sitenames, cells = 64):
+        self.geometries = np.asarray(geometries, dtype = object)
+        self.sitenames = np.asarray(sitenames, dtype = object)
+        self.n_zones = len(self.geometries)
+        shapely.prepare(self.geometries)
+
+        self.minx, self.miny, self.maxx, self.maxy = shapely.total_bounds(self.geometries)
+        self.nx = self.ny = cells
+        self.dx = (self.maxx - self.minx) / self.nx
+        self.dy = (self.maxy - self.miny) / self.ny
+
+        # Cell boxes, numbered row by row from the south west corner
+        ix, iy = np.meshgrid(np.arange(self.nx), np.arange(self.ny))
+        ix, iy = ix.ravel(), iy.ravel()
+        boxes = shapely.box(self.minx + ix * self.dx - self._cell_pad,
+                            self.miny + iy * self.dy - self._cell_pad,
+                            self.minx + (ix + 1) * self.dx + self._cell_pad,
+                            self.miny + (iy + 1) * self.dy + self._cell_pad)
+
+        # candidates[cell, zone] is True when the zone touches the cell
+        tree = STRtree(self.geometries)
+        cell_idx, zone_idx = tree.query(boxes, predicate = 'intersects')
+        self.candidates = np.zeros((len(boxes), self.n_zones), dtype = bool)
+        self.candidates[cell_idx, zone_idx] = True
+
+        # A cell is resolved directly when the first zone touching it
+        # contains the whole cell in its interior
+        self.cell_zone = np.full(len(boxes), -1, dtype = np.int32)
+        touched = self.candidates.any(axis = 1)
+        first = np.argmax(self.candidates, axis = 1)
+        cells_hit = np.flatnonzero(touched)
+        inside = shapely.contains_properly(self.geometries[first[cells_hit]], boxes[cells_hit])
+        self.cell_zone[cells_hit[inside]] = first[cells_hit[inside]]
+
+    @classmethod
+    def from_gdf(cls, gdf, **kwargs):
+        """
+        Builds the index from a zone GeoDataFrame, as returned by load_zones
+        """
+        return cls(gdf['geometry'].values, gdf['sitename'].values, **kwargs)
+
+    def _cells(self, x, y):
+        """
+        Returns the grid cell of each coordinate pair, or -1 for points
+        outside the zone bounding box
+        """
+        with np.errstate(invalid = 'ignore'):
+            in_bounds = ((x >= self.minx) & (x <= self.maxx) &
+                         (y >= self.miny) & (y <= self.maxy))
+        cells = np.full(len(x), -1, dtype = np.int64)
+        ix = np.minimum(((x[in_bounds] - self.minx) / self.dx).astype(np.int64), self.nx - 1)
+        iy = np.minimum(((y[in_bounds] - self.miny) / self.dy).astype(np.int64), self.ny - 1)
+        cells[in_bounds] = iy * self.nx + ix
+        return cells
+
+    def assign_codes(self, x, y):
+        """
+        Assigns each point to the zone it lies within.
+
+        Parameters
+        ----------
+        x, y : array-like
+            float longitude and latitude of each point
+
+        Returns
+        -------
+        numpy.ndarray
+            int32 row position in the zone table of each point, -1 where
+            the point is not inside any zone
+        """
+        x = np.ascontiguousarray(x, dtype = np.float64)
+        y = np.ascontiguousarray(y, dtype = np.float64)
+        cells = self._cells(x, y)
+        codes = np.full(len(x), -1, dtype = np.int32)
+
+        # Fast path: cells that lie inside a single zone
+        in_grid = np.flatnonzero(cells >= 0)
+        codes[in_grid] = self.cell_zone[cells[in_grid]]
+
+        # Exact tests for points in cells on zone boundaries, zone by zone in
+        # row order so the first zone containing a point wins
+        pending = in_grid[codes[in_grid] < 0]
+        pending_candidates = self.candidates[cells[pending]]
+        unresolved = np.ones(len(pending), dtype = bool)
+        for zone in np.flatnonzero(pending_candidates.any(axis = 0)):
+            test = np.flatnonzero(unresolved & pending_candidates[:, zone])
+            if len(test) == 0:
+                continue
+            points = pending[test]
+            hits = shapely.contains_xy(self.geometries[zone], x[points], y[points])
+            codes[points[hits]] = zone
+            unresolved[test[hits]] = False
+        return codes
+
+    def assign(self, x, y):
+        """
+        Assigns each point to the sitename of the zone it lies within.
+
+        Parameters
+        ----------
+        x, y : array-like
+            float longitude and latitude of each point
+
+        Returns
+        -------
+        numpy.ndarray
+            object array of sitenames, None where the point is not inside
+            any zone (as map_park_site returns)
+        """
+        return self.sitenames_of(self.assign_codes(x, y))
+
+    def sitenames_of(self, codes):
+        """
+        Returns the sitename for each zone code, None for code -1
+        """
+        sitenames = np.full(len(codes), None, dtype = object)
+        found = codes >= 0
+        sitenames[found] = self.sitenames[codes[found]]
+        return sitenames
+
+def hectare_grid_xy(x, y):
+    """
+    Returns the position of each point in the hectare grid, in hectares
+    east of the west edge and north of the south edge of the grid
+    """
+    east = grid_se - grid_sw
+    north = grid_nw - grid_sw
+    u, v = np.linalg.solve(np.column_stack([east, north]),
+                           np.vstack([np.asarray(x) - grid_sw[0], np.asarray(y) - grid_sw[1]]))
+    return u * grid_cols, v * grid_rows
+
+def hectare_of(x, y):
+    """
+    Returns the census hectare id (for example "14E") of each point,
+    using the approximate corners of the hectare grid
+    """
+    u, v = hectare_grid_xy(x, y)
+    col = np.clip(u.astype(int), 0, grid_cols - 1)
+    row = np.clip(v.astype(int), 0, grid_rows - 1) + 1
+    letters = np.array(list(grid_letters))
+    return np.char.add(np.char.zfill(row.astype(str), 2), letters[col])
+
+def hectare_numbers(hectares):
+    """
+    Returns the number of each census hectare id in "hectares" in the grid,
+    numbered row by row from the south west corner, or -1 for missing or
+    unrecognised ids
+    """
+    labels = pd.Categorical(hectares)
+    numbers = np.full(len(labels.categories) + 1, -1, dtype = np.int64)
+    for i, label in enumerate(labels.categories):
+        match = re.fullmatch(r'(\d{1,2})([A-I])', str(label).strip().upper())
+        if match and 1 <= int(match.group(1)) <= grid_rows:
+            numbers[i] = (int(match.group(1)) - 1) * grid_cols + grid_letters.index(match.group(2))
+    # Code -1 (missing) picks the -1 at the end of "numbers"
+    return numbers[labels.codes]
+
+class HectareIndex:
+    """
+    Lookup from census hectare to park zone, for assigning observations to
+    zones without geometry tests.
+
+    The hectare grid is small and fixed, so each hectare is tested against
+    the zone polygons once. A hectare that lies strictly inside the first
+    zone (in row order) touching it resolves to that zone, and a hectare
+    that no zone touches resolves to no zone. An observation in one of
+    those hectares is then assigned with an array lookup, as long as its
+    point lies inside the hectare it is recorded in. Observations in
+    hectares on zone boundaries, with a missing or unknown hectare, or whose
+    point lies outside their hectare (the grid corners are approximate) are
+    assigned by the ZoneIndex, so the codes are the same as ZoneIndex and
+    map_park_site give.
+
+    Parameters
+    ----------
+    zones : numpy.ndarray
+        int32 zone code each hectare resolves to, in hectare number order
+        (-1 for no zone)
+    resolved : numpy.ndarray
+        bool, True for hectares that resolve without geometry tests
+    """
+
+    # Points this close to a hectare edge, in hectares, are left to the
+    # ZoneIndex, so rounding in the grid arithmetic can never place a point
+    # in the wrong hectare
+    _edge = 1e-9
+
+    def __init__(self, zones, resolved):
+        self.zones = np.asarray(zones, dtype = np.int32)
+        self.resolved = np.asarray(resolved, dtype = bool)
+
+    @staticmethod
+    def labels():
+        """
+        Returns the id of every census hectare, in hectare number order
+        """
+        return ['{:02d}{}'.format(row + 1, letter) for row in range(grid_rows) for letter in grid_letters]
+
+    @staticmethod
+    def boxes():
+        """
+        Returns the polygon of every census hectare, in hectare number order
+        """
+        row, col = np.divmod(np.arange(grid_rows * grid_cols), grid_cols)
+        east = (grid_se - grid_sw) / grid_cols
+        north = (grid_nw - grid_sw) / grid_rows
+        corners = [grid_sw + np.outer(col + dc, east) + np.outer(row + dr, north)
+                   for dc, dr in [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]]
+        return shapely.polygons(np.stack(corners, axis = 1))
+
+    @classmethod
+    def from_gdf(cls, gdf):
+        """
+        Builds the lookup from a zone GeoDataFrame, as returned by load_zones
+        """
+        geometries = np.asarray(gdf['geometry'].values, dtype = object)
+        boxes = cls.boxes()
+        box_idx, zone_idx = STRtree(geometries).query(boxes, predicate = 'intersects')
+        touched = np.zeros((len(boxes), len(geometries)), dtype = bool)
+        touched[box_idx, zone_idx] = True
+
+        zones = np.full(len(boxes), -1, dtype = np.int32)
+        first = np.argmax(touched, axis = 1)
+        hit = np.flatnonzero(touched.any(axis = 1))
+        inside = shapely.contains_properly(geometries[first[hit]], boxes[hit])
+        zones[hit[inside]] = first[hit[inside]]
+        # Hectares no zone touches resolve to no zone
+        resolved = ~touched.any(axis = 1)
+        resolved[hit[inside]] = True
+        return cls(zones, resolved)
+
+    @classmethod
+    def from_table(cls, table, sitenames = None):
+        """
+        Builds the lookup from the table written by to_table. Rows with an
+        unrecognised hectare id are left out, and hectares without a row
+        are looked up with the ZoneIndex.
+
+        Raises
+        ------
+        ValueError
+            if "sitenames" (the sitename of each zone, in the order of the
+            zone codes) is given and the table does not name the same zone
+            for every hectare, for example because it was built from
+            another zone file
+        """
+        numbers = hectare_numbers(table['hectare'])
+        table = table[numbers >= 0]
+        numbers = numbers[numbers >= 0]
+        codes = table['zone'].to_numpy().astype(np.int64)
+        if sitenames is not None:
+            sitenames = np.asarray(sitenames, dtype = object)
+            inside = codes >= 0
+            if ((codes < -1) | (codes >= len(sitenames))).any():
+                raise ValueError('The hectare table has zone codes that are not in the zone file')
+            expected = np.full(len(codes), None, dtype = object)
+            expected[inside] = sitenames[codes[inside]]
+            named = table['sitename'].to_numpy(dtype = object)
+            named = np.where(pd.isna(named), None, named)
+            if not (expected == named).all():
+                raise ValueError('The hectare table was built from another zone file')
+        zones = np.full(grid_rows * grid_cols, -1, dtype = np.int32)
+        resolved = np.zeros(grid_rows * grid_cols, dtype = bool)
+        zones[numbers] = codes
+        resolved[numbers] = table['status'].to_numpy() != 'boundary'
+        return cls(zones, resolved)
+
+    def to_table(self, sitenames):
+        """
+        Returns the lookup as a table with one row per hectare: its id, the
+        zone code and sitename it resolves to, and its status ("inside" a
+        zone, "outside" every zone, or on a zone "boundary")
+        """
+        status = np.where(~self.resolved, 'boundary', np.where(self.zones >= 0, 'inside', 'outside'))
+        sitename = np.full(len(self.zones), None, dtype = object)
+        sitename[self.zones >= 0] = np.asarray(sitenames, dtype = object)[self.zones[self.zones >= 0]]
+        return pd.DataFrame({'hectare': self.labels(), 'zone': self.zones,
+                             'sitename': sitename, 'status': status})
+
+    def lookup(self, x, y, hectares):
+        """
+        Assigns each point to a zone by its census hectare where possible.
+
+        Parameters
+        ----------
+        x, y : array-like
+            float longitude and latitude of each point
+        hectares : array-like
+            census hectare id of each point
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            int32 zone code of each point, and a bool mask of the points
+            assigned by the lookup (the codes of the others are -1)
+        """
+        numbers = hectare_numbers(hectares)
+        # Only points recorded in hectares that resolve need their position
+        # in the grid checked
+        rows = np.flatnonzero(numbers >= 0)
+        rows = rows[self.resolved[numbers[rows]]]
+        u, v = hectare_grid_xy(np.asarray(x, dtype = np.float64)[rows], np.asarray(y, dtype = np.float64)[rows])
+        row, col = np.divmod(numbers[rows], grid_cols)
+        with np.errstate(invalid = 'ignore'):
+            in_hectare = ((u > col + self._edge) & (u < col + 1 - self._edge) &
+                          (v > row + self._edge) & (v < row + 1 - self._edge))
+        rows = rows[in_hectare]
+        codes = np.full(len(numbers), -1, dtype = np.int32)
+        codes[rows] = self.zones[numbers[rows]]
+        found = np.zeros(len(numbers), dtype = bool)
+        found[rows] = True
+        return codes, found
+
+    def assign_codes(self, x, y, hectares, zone_index):
+        """
+        Assigns each point to the zone it lies within, by its census hectare
+        where possible and with "zone_index" (a ZoneIndex) otherwise.
+
+        Returns
+        -------
+        numpy.ndarray
+            int32 row position in the zone table of each point, -1 where
+            the point is not inside any zone
+        """
+        x = np.ascontiguousarray(x, dtype = np.float64)
+        y = np.ascontiguousarray(y, dtype = np.float64)
+        codes, found = self.lookup(x, y, hectares)
+        rest = np.flatnonzero(~found)
+        codes[rest] = zone_index.assign_codes(x[rest], y[rest])
+        return codes
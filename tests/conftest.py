@@ -0,0 +1,29 @@
+# Load packages
+
+import os
+import sys
+import pytest
+
+# The wrangle scripts import each other as top-level modules, and read the
+# project data from paths relative to the root of the repository
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'scripts'))
+
+@pytest.fixture(autouse = True)
+def repository_root(monkeypatch):
+    monkeypatch.chdir(root)
+
+@pytest.fixture(scope = 'session')
+def census_path(tmp_path_factory):
+    """
+    Filepath of a synthetic census the size of the 2018 census
+    """
+    from synthetic import synthetic_census
+    path = tmp_path_factory.mktemp('census') / 'census.csv'
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        synthetic_census(1).to_csv(path, index = False)
+    finally:
+        os.chdir(cwd)
+    return str(path)
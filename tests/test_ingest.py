@@ -0,0 +1,79 @@
+# Load packages
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from aggregate import SiteCube
+from ingest import Ingester, processed_dir, version_file, watch
+from topo import to_topojson
+from wrangle_full import wrangle, write_outputs
+from zones import geojson_filepath, load_zones, HectareIndex
+
+def wrangle_to(source, out_dir):
+    """
+    Writes the data files of the census at "source" to "out_dir", as
+    wrangle_full.py --no-cache does, and returns the squirrel_count table
+    and cube
+    """
+    squirrel_count, choro_json, cube, density_json = wrangle(source)
+    gdf = load_zones(geojson_filepath)
+    hectare_table = HectareIndex.from_gdf(gdf).to_table(gdf['sitename'].values)
+    write_outputs(squirrel_count, choro_json, to_topojson(choro_json), cube, density_json, hectare_table, out_dir)
+    return squirrel_count, cube
+
+def stored_cube(data_dir):
+    with np.load(os.path.join(data_dir, 'squirrel_cube.npz')) as stored:
+        return SiteCube.from_arrays({name: stored[name] for name in stored.files})
+
+def test_ingest_matches_full_wrangle(tmp_path, census_path):
+    census = pd.read_csv(census_path)
+    head = tmp_path / 'head.csv'
+    census.iloc[:2000].to_csv(head, index = False)
+    data_dir = tmp_path / 'data'
+    drop_dir = tmp_path / 'drop'
+    data_dir.mkdir()
+    drop_dir.mkdir()
+    wrangle_to(str(head), str(data_dir))
+    # The rest of the census arrives in two batches
+    census.iloc[2000:2500].to_csv(drop_dir / 'sightings.csv', index = False)
+    census.iloc[2500:].to_csv(drop_dir / 'sightings-2.csv', index = False)
+
+    ingester = Ingester(str(data_dir))
+    watch(ingester, str(drop_dir), once = True)
+
+    full_count, full_cube = wrangle_to(census_path, str(tmp_path))
+    with open(data_dir / 'squirrel_count.csv') as count_file:
+        assert count_file.read() == full_count.to_csv()
+    cube = stored_cube(str(data_dir))
+    assert cube.levels == full_cube.levels
+    assert np.array_equal(cube.counts, full_cube.counts)
+    version = ingester.read_version()
+    assert not version['writing'] and version['batches'] == 2
+
+    # The same batch dropped again, under the same and another name, is
+    # not counted again and does not overwrite the processed batches
+    shutil.copy(drop_dir / processed_dir / 'sightings.csv', drop_dir / 'sightings.csv')
+    shutil.copy(drop_dir / processed_dir / 'sightings.csv', drop_dir / 'again.csv')
+    files = {name: (data_dir / name).read_bytes() for name in ['squirrel_count.csv', 'squirrel_cube.npz']}
+    assert ingester.ingest([str(drop_dir / 'sightings.csv'), str(drop_dir / 'again.csv')]) == 0
+    watch(ingester, str(drop_dir), once = True)
+    assert {name: (data_dir / name).read_bytes() for name in files} == files
+    assert sorted(os.listdir(drop_dir / processed_dir)) == ['again.csv', 'sightings-2.csv',
+                                                           'sightings.1.csv', 'sightings.csv']
+
+def test_unfinished_update_is_completed(tmp_path, census_path):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    full_count, _ = wrangle_to(census_path, str(data_dir))
+    # An update that stopped after the cube was written
+    with open(data_dir / version_file, 'w') as f:
+        json.dump({'version': 3, 'writing': True}, f)
+    os.remove(data_dir / 'squirrel_count.csv')
+
+    ingester = Ingester(str(data_dir))
+    assert ingester.read_version() == {'version': 4, 'writing': False,
+                                       'rows': int(full_count['Unique_Squirrel_ID'].sum()), 'batches': 0}
+    with open(data_dir / 'squirrel_count.csv') as count_file:
+        assert count_file.read() == full_count.to_csv()
@@ -0,0 +1,34 @@
+# Load packages
+
+import json
+import numpy as np
+import pytest
+from wrangle_full import wrangle
+
+@pytest.fixture(scope = 'module')
+def batch(census_path):
+    return wrangle(census_path)
+
+@pytest.mark.parametrize('chunksize', [100, 1000, 5000])
+def test_streaming_matches_batch(census_path, batch, chunksize):
+    batch_count, batch_json, batch_cube, batch_density = batch
+    squirrel_count, choro_json, cube, density = wrangle(census_path, chunksize = chunksize)
+    assert squirrel_count.equals(batch_count)
+    assert choro_json == batch_json
+    assert cube.levels == batch_cube.levels
+    assert np.array_equal(cube.counts, batch_cube.counts)
+    assert density == batch_density
+
+def test_counts_every_observation(census_path, batch):
+    squirrel_count, choro_json, cube, density = batch
+    assert squirrel_count['Unique_Squirrel_ID'].sum() == cube.counts[..., 0].sum()
+    assert squirrel_count['Unique_Squirrel_ID'].sum() > 0
+
+def test_workers_match_batch(census_path, batch):
+    batch_count, batch_json, batch_cube, batch_density = batch
+    squirrel_count, choro_json, cube, density = wrangle(census_path, chunksize = 1000, workers = 2)
+    assert squirrel_count.to_csv() == batch_count.to_csv()
+    assert json.dumps(choro_json) == json.dumps(batch_json)
+    assert cube.levels == batch_cube.levels
+    assert np.array_equal(cube.counts, batch_cube.counts)
+    assert json.dumps(density) == json.dumps(batch_density)
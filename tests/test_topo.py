@@ -0,0 +1,30 @@
+# Load packages
+
+import json
+import geopandas as gpd
+import pytest
+from shapely.geometry import Polygon
+from topo import check_zones, default_tolerance, to_topojson
+from wrangle_full import wrangle
+
+@pytest.fixture(scope = 'module')
+def choro_json(census_path):
+    return wrangle(census_path)[1]
+
+@pytest.mark.parametrize('tolerance', [0, default_tolerance, 1e-4])
+def test_simplified_zones_are_valid(tmp_path, choro_json, tolerance):
+    path = tmp_path / 'zones.topo.json'
+    with open(path, 'w') as topo_file:
+        json.dump(to_topojson(choro_json, tolerance), topo_file)
+    zones = gpd.read_file(path)
+
+    sitenames = [feature['properties']['sitename'] for feature in choro_json['features']]
+    assert sorted(zones['sitename']) == sorted(sitenames)
+    assert zones.is_valid.all()
+    assert not zones.is_empty.any()
+
+def test_check_zones_rejects_empty_geometry():
+    square = Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+    simplified = gpd.GeoDataFrame({'sitename': ['A', 'B'], 'geometry': [square, Polygon()]})
+    with pytest.raises(ValueError, match = 'B'):
+        check_zones(simplified, ['A', 'B'])